@@ -4,7 +4,7 @@ Downloads data from the adcon system since a given date
 """
 
 import sys
-from unilogger.bus import Bus
+from unilogger.bus import open_bus
 from datetime import timedelta, datetime
 from unilogger.csvlogger import Csv
 import asyncio
@@ -30,14 +30,27 @@ def await_coro(coro):
     return asyncio.get_event_loop().run_until_complete(waitfor(coro))
 
 
+async def download(bus, csv, start_date, checkpoint):
+    """
+    Downloads the history of all sensors page by page into csv, resumes from the checkpoint
+    """
+    def onread(values):
+        csv(values)
+        print('...got {} values'.format(len(values)))
+
+    async with bus:
+        return await bus.backfill(start_date, onread, checkpoint=checkpoint, slots=10000)
+
+
 if __name__ == '__main__':
     # Check the commandline syntax for number of entries
     if len(sys.argv)<4:
         print('Usage: test/addupi-download.py [bus.yaml] [output.csv] [startdate yyyymmdd-hhmm]')
+        print('       An interrupted download is resumed from [output.csv].checkpoint')
         exit()
         
     # Create a bus from the bus description
-    bus = Bus.from_file(sys.argv[1])
+    bus = open_bus(sys.argv[1])
     csv = Csv(sys.argv[2], 'a')
     try:
         start_date = datetime.strptime(sys.argv[3], '%Y%m%d-%H%M')
@@ -45,9 +58,7 @@ if __name__ == '__main__':
         print('Wrong date format: {} does not match yyyymmdd-hhmm. 20160901-1340 would work')
         exit()
     else:
-        for sensor in bus.sensors:
-            print('Read sensor:', sensor)
-            res = await_coro(bus.readsensor(sensor, fromdate=start_date, slots=100000))
-            print('...got {} values'.format(len(res)))
-            csv(res)
+        print('Read sensors:', ', '.join(str(sensor) for sensor in bus.sensors))
+        count = await_coro(download(bus, csv, start_date, sys.argv[2] + '.checkpoint'))
+        print('Downloaded {} values'.format(count))
     csv.close()
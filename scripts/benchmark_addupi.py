@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Benchmark for parsing AddUPI getdata responses
+
+Creates a getdata response with 3 tags and n slots, like a bulk download with
+scripts/addupi-download.py, and compares the former BeautifulSoup path with the
+streaming lxml parser (addupi.DataStream) in time and peak memory.
+
+Usage: scripts/benchmark_addupi.py [number of slots]
+"""
+import sys
+import time
+import tracemalloc
+
+from bs4 import BeautifulSoup
+
+from unilogger.bus import addupi
+
+NTAGS = 3
+CHUNKSIZE = 0x10000
+
+
+def make_response(slots: int) -> bytes:
+    """
+    A getdata response with a value every 15 minutes for each tag
+    """
+    nodes = []
+    for tag in range(NTAGS):
+        values = ['<v t="20260101T00:00:00">0.0</v>']
+        values += ['<v t="+900">{:0.1f}</v>'.format(i * 0.1) for i in range(1, slots)]
+        nodes.append('<node id="{}">{}</node>'.format(tag, ''.join(values)))
+    return '<?xml version="1.0"?><response>{}</response>'.format(''.join(nodes)).encode()
+
+
+def parse_soup(data: bytes) -> int:
+    """
+    The former path: the complete response as BeautifulSoup
+    """
+    soup = BeautifulSoup(data, 'xml')
+    count = 0
+    for node in soup.response.find_all('node'):
+        for v_elem in node('v', recursive=False):
+            float(v_elem.string)
+            count += 1
+    return count
+
+
+def parse_stream(data: bytes) -> int:
+    """
+    The streaming path, fed in chunks as received by aiohttp
+    """
+    stream = addupi.DataStream()
+    count = 0
+    for i in range(0, len(data), CHUNKSIZE):
+        for node_id, t, v in stream.feed(data[i:i + CHUNKSIZE]):
+            float(v)
+            count += 1
+    stream.close()
+    return count
+
+
+def measure(name, parse, data):
+    tracemalloc.start()
+    start = time.perf_counter()
+    count = parse(data)
+    seconds = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print('{:>8}: {:8.3f} s {:10.0f} values/s {:8.1f} MB peak'.format(
+        name, seconds, count / seconds, peak / 2**20))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    data = make_response(n)
+    print('getdata response with {} tags x {} slots ({:0.1f} MB)'.format(NTAGS, n, len(data) / 2**20))
+    measure('soup', parse_soup, data)
+    measure('stream', parse_stream, data)
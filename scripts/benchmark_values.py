@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the creation of values by ValueFactory.__call__
+
+Simulates the readout of a 10-value SDI12 sensor (like the vaisala in settings/sdi12.bus.yaml)
+and compares the per sample cost and memory of the current Value with the former implementation,
+where Value was a collections.UserDict with a copy of the factory metadata.
+
+Usage: scripts/benchmark_values.py [number of readouts]
+"""
+import collections
+import datetime
+import sys
+import timeit
+import tracemalloc
+
+from unilogger.bus import base
+
+NVALUES = 10
+
+
+class LegacyValue(collections.UserDict):
+    """
+    The Value implementation before the slotted Value, for comparison
+    """
+    def __init__(self, value, time=None, name=None, unit=None, **kwargs):
+        self.value = value
+        self.name = name
+        self.time = time
+        self.unit = unit
+        self.extradata = kwargs
+
+
+def legacy_call(factory, value, time=None, **kwargs):
+    """
+    The former ValueFactory.__call__, copies and merges the metadata for each value
+    """
+    if factory.scalefunction:
+        value = factory.scalefunction(value)
+    time = time or datetime.datetime.utcnow()
+    data = factory.extradata.copy()
+    data.update(kwargs)
+    return LegacyValue(value, time, factory.name, unit=factory.unit, **data)
+
+
+def make_factories():
+    """
+    The valuefactories of a SDI12 sensor, as created by sdi12.Sensor
+    """
+    return [
+        base.ValueFactory(name='bench.Value_{:02d}'.format(i), id=i, unit='-', datasetid=None)
+        for i in range(NVALUES)
+    ]
+
+
+def readout(factories, create):
+    time = datetime.datetime.utcnow()
+    return [create(vf, float(i), time) for i, vf in enumerate(factories)]
+
+
+def measure(name, create, number):
+    factories = make_factories()
+    seconds = min(timeit.repeat(lambda: readout(factories, create), number=number, repeat=5))
+    tracemalloc.start()
+    values = [readout(factories, create) for _ in range(100)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del values
+    samples = number * NVALUES
+    print('{:>8}: {:8.3f} µs/sample {:8.0f} bytes/sample'.format(
+        name, seconds / samples * 1e6, size / (100 * NVALUES)))
+
+
+if __name__ == '__main__':
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    print('{} readouts of a {}-value SDI12 sensor'.format(n, NVALUES))
+    measure('legacy', legacy_call, n)
+    measure('current', lambda vf, x, t: vf(x, t), n)
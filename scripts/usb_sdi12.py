@@ -33,17 +33,17 @@ def console(port):
             print('Command did not end with !')
 
 
-async def scanbus(port):
+async def scanbus(ports):
+    """
+    Scans the comma separated ports concurrently and writes the bus description
+    """
     if len(sys.argv) > 3:
         out = open(sys.argv[3], 'w')
     else:
         out = sys.stdout
-    print('Create bus')
-    bus = sdi12.SDI12Bus(port)
-    bus.debug = True
-    print('SDI12 bus open on', port)
-    bus.sensors = await bus.scanbus('0123')
-
+    ports = ports.split(',')
+    print('Scan SDI12 bus on', ', '.join(ports), file=sys.stderr)
+    bus = await sdi12.scan(*ports)
     bus.to_stream(out)
 
 
@@ -75,6 +75,7 @@ if __name__ == '__main__':
         print('   c: opens a SDI12 console on port [port]')
         print('   s: Scans the bus at port [port] and writes a new busfile [busfile]')
         print('        eg. test/usb_sdi12.py s /dev/ttyUSB4 preferences/sdi12.bus.yaml')
+        print('        several ports are scanned concurrently: s /dev/ttyUSB0,/dev/ttyUSB1')
         print('   r: Reads actual data using the busfile, eg. test/usb_sdi12.py r preferences/sdi12.bus.yaml')
         print('   a: Changes the logger address')
         print('      usb_sdi12.py a [port] [new address]')
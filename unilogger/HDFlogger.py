@@ -1,5 +1,8 @@
 import pandas as pd
 
+from .bus.base import ValueBatch
+
+
 class HDFLogger:
     def __init__(self, filename, hdf_key='data'):
         # self.store = pd.HDFStore(filename)
@@ -7,7 +10,10 @@ class HDFLogger:
         self.key = hdf_key
 
     def __call__(self, values, variableprefix=''):
-        df = pd.DataFrame([v.__asdict__() for v in values])
+        if isinstance(values, ValueBatch):
+            df = pd.DataFrame(values.columns())
+        else:
+            df = pd.DataFrame([v.__asdict__() for v in values])
         df.to_hdf(self.filename, self.key, append=True, index=False, data_columns=True)
 
     def close(self):
@@ -20,10 +20,11 @@ The general layout of a Bus is:
 Every Bus must implement the following methods:
 
 - **__asdict__**: Returns a dictionary that describes a bus with every attached sensor and measured values
-- **read_all** (coroutine): Reads all values defined for the bus and returns a list of Values (see: :py:class:`unilogger.bus.Value`)
+- **read_all** (coroutine): Reads all values defined for the bus and returns a ValueBatch
+  (see: :py:class:`unilogger.bus.ValueBatch`), iterating the batch yields Values (see: :py:class:`unilogger.bus.Value`)
 - **__init__**: The Init function must accept all key words from the defining yaml file
 
 The open_bus function loads the bus description (usally from a yaml file
 """
 
-from .base import open_bus, Value, ValueFactory
+from .base import open_bus, Value, ValueFactory, ValueBatch
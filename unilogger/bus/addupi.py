@@ -3,14 +3,23 @@
 """
 import typing
 import sys
+import asyncio
+import array
+import inspect
+
+import numpy as np
+import pandas as pd
 
 import aiohttp
 import datetime
 from bs4 import BeautifulSoup
+from lxml import etree
 
 
 from . import base
 
+import logging
+logger = logging.getLogger(__name__)
 
 class AddUPIError(base.BusError):
     pass
@@ -51,12 +60,138 @@ class Sensor(base.Sensor):
         return res
 
 
+class TimeDecoder:
+    """
+    Decodes the time stamps of AddUPI values to seconds since the epoch (UTC).
+
+    Absolute times have the fixed format ``YYYYmmddTHH:MM:SS`` and are sliced at fixed
+    offsets, the seconds of each day are cached. Relative times ``+N`` add N seconds
+    to the previous time of the node, hence each node needs its own decoder.
+
+    Usage:
+    >>> decode = TimeDecoder()
+    >>> decode('20260101T00:00:00'), decode('+900')
+    (1767225600, 1767226500)
+    """
+    __days: typing.Dict[str, int] = {}
+    __epoch = datetime.date(1970, 1, 1).toordinal()
+
+    def __init__(self):
+        self.last: typing.Optional[int] = None
+
+    def __call__(self, t: str) -> int:
+        if t[:1] == '+':
+            if self.last is None:
+                raise AddUPIError(f'AddUPI relative time {t} without a preceding absolute time')
+            self.last += int(t[1:])
+        elif len(t) == 17 and t[8] == 'T' and t[11] == t[14] == ':':
+            day = self.__days.get(t[:8])
+            if day is None:
+                date = datetime.date(int(t[:4]), int(t[4:6]), int(t[6:8]))
+                day = self.__days[t[:8]] = (date.toordinal() - self.__epoch) * 86400
+            self.last = day + int(t[9:11]) * 3600 + int(t[12:14]) * 60 + int(t[15:17])
+        else:
+            raise ValueError(f'AddUPI time {t} does not match the format YYYYmmddTHH:MM:SS or +N')
+        return self.last
+
+
+class DataStream:
+    """
+    Incremental parser for getdata responses.
+
+    Chunks of the response body are fed into an lxml pull parser and the values are
+    returned as soon as their ``<v>`` element is complete. Finished elements are
+    removed from the tree, hence the memory does not grow with the size of the response.
+
+    Usage:
+    >>> stream = DataStream()
+    >>> for chunk in chunks:
+    >>>     for node_id, t, v in stream.feed(chunk):
+    >>>         ...
+    >>> stream.close()
+    """
+    def __init__(self):
+        self.parser = etree.XMLPullParser(events=('start', 'end'))
+        self.depth = 0
+        self.node_id = None
+        self.has_response = False
+        # Errors of nodes as (node id, error attributes)
+        self.errors: typing.List[typing.Tuple[str, dict]] = []
+
+    def feed(self, data: bytes) -> typing.Iterator[typing.Tuple[str, str, str]]:
+        """
+        Parses a chunk of the response
+        :param data: The next chunk of the response body
+        :return: Iterator over (node id, time string, value string) of the completed values
+        """
+        try:
+            self.parser.feed(data)
+        except etree.XMLSyntaxError as e:
+            raise AddUPIError(f'AddUPI connection failed, could not parse response: {e}') from e
+        return self.events()
+
+    def events(self):
+        for event, elem in self.parser.read_events():
+            if event == 'start':
+                self.depth += 1
+                if self.depth == 1:
+                    self.has_response = elem.tag == 'response'
+                elif self.depth == 2 and elem.tag == 'node':
+                    self.node_id = elem.get('id')
+                continue
+            self.depth -= 1
+            if elem.tag == 'v':
+                yield self.node_id, elem.get('t'), elem.text
+            elif elem.tag == 'error':
+                if self.depth == 1:
+                    raise AddUPIError('AddUPI connection failed got Error code {code}: {msg}'.format_map(
+                        dict(code=elem.get('code'), msg=elem.get('msg'))))
+                self.errors.append((self.node_id, dict(elem.attrib)))
+            if self.depth >= 1:
+                # Drop the finished element and its predecessors
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+
+    def close(self):
+        """
+        Finishes the parsing, raises an AddUPIError for an incomplete or invalid response
+        """
+        try:
+            self.parser.close()
+        except etree.XMLSyntaxError as e:
+            raise AddUPIError(f'AddUPI connection failed, incomplete response: {e}') from e
+        if not self.has_response:
+            raise AddUPIError('AddUPI connection failed, no response tag')
+
+
 class Bus(base.Bus):
-    def __init__(self, url, user=None, password=None, sensors=None, **kwargs):
+    """
+    An ADCON A840/A850 base station, read with the AddUPI protocol over http.
+
+    The bus keeps one http session with keep-alive connections to the base station,
+    the connection handshake is only paid once. Use the bus as an async context manager
+    to login and close the connections afterwards, or call :py:meth:`close` when done.
+    """
+    def __init__(self, url, user=None, password=None, sensors=None,
+                 max_connections=4, keepalive=60.0, **kwargs):
+        """
+        :param url: The url of the AddUPI server, eg. http://a850/addUPI
+        :param user: The user name for the login
+        :param password: The password for the login
+        :param sensors: List of dict, describing the sensors
+        :param max_connections: Maximum number of simultaneous connections and sensor reads at the base station
+        :param keepalive: Seconds to keep an idle connection open for the next request
+        """
         self.url = url
+        # The AddUPI session id
         self.session = None
         self.user = user
         self.password = password
+        self.max_connections = max_connections
+        self.keepalive = keepalive
+        self.__http: typing.Optional[aiohttp.ClientSession] = None
+        self.__http_loop = None
         self.extradata = kwargs
         if sensors:
             self.sensors = [Sensor(**s) for s in sensors]
@@ -65,7 +200,8 @@ class Bus(base.Bus):
 
     def __asdict__(self):
         res = self.extradata.copy()
-        res.update(dict(url=self.url, user=self.user, password=self.password))
+        res.update(dict(url=self.url, user=self.user, password=self.password,
+                        max_connections=self.max_connections, keepalive=self.keepalive))
         res['module'] = __name__
         res['sensors'] = []
         for s in self.sensors:
@@ -77,9 +213,34 @@ class Bus(base.Bus):
 
     async def __aenter__(self):
         await self.login()
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.logout()
+        try:
+            await self.logout()
+        finally:
+            await self.close()
+
+    @property
+    def http(self) -> aiohttp.ClientSession:
+        """
+        The http session of the bus, opened with the first use in the running event loop
+        """
+        loop = asyncio.get_running_loop()
+        if self.__http is None or self.__http.closed or self.__http_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive,
+                                             ttl_dns_cache=None)
+            self.__http = aiohttp.ClientSession(connector=connector)
+            self.__http_loop = loop
+        return self.__http
+
+    async def close(self):
+        """
+        Closes the connections to the base station, the next request opens a new one
+        """
+        if self.__http is not None and not self.__http.closed:
+            await self.__http.close()
+        self.__http = None
 
     def makesensor(self, id: str, name=None, values=None, **kwargs):
         """
@@ -112,31 +273,65 @@ class Bus(base.Bus):
         """
         if self.session and 'session-id' not in params:
             params['session-id'] = self.session
-        async with aiohttp.ClientSession() as session:
-            # GET response to function
-            async with session.get(self.url, params=params) as r:
-                # check response
-
-                # status check
-                if r.status // 100 > 2:
-                    raise AddUPIError('AddUPI connection failed, got status {} from {}'.format(r.status, r.url))
-                # get text
-                text = await r.text()
-                # parse text
-                try:
-                    soup = BeautifulSoup(text, 'xml')
-                except Exception as e:
-                    raise AddUPIError('AddUPI connection failed, could not parse response from {}\nResponse:\n{}'
-                                      .format(r.url, text)) from e
-                # check for response
-                if not soup.response:
-                    raise AddUPIError('AddUPI connection failed, no response tag from {}, got instead:\n{}'
-                                      .format(r.url, soup.prettify()))
-                # check for error
-                if error := soup.response.find('error', recursive=False):
-                    raise AddUPIError('AddUPI connection failed got Error code {code}: {msg} on {url}'
-                                      .format(url=r.url, **error.attrs))
-                return soup, r.url
+        # GET response to function
+        async with await self.get(params) as r:
+            # get text
+            text = await r.text()
+            # parse text
+            try:
+                soup = BeautifulSoup(text, 'xml')
+            except Exception as e:
+                raise AddUPIError('AddUPI connection failed, could not parse response from {}\nResponse:\n{}'
+                                  .format(r.url, text)) from e
+            # check for response
+            if not soup.response:
+                raise AddUPIError('AddUPI connection failed, no response tag from {}, got instead:\n{}'
+                                  .format(r.url, soup.prettify()))
+            # check for error
+            if error := soup.response.find('error', recursive=False):
+                raise AddUPIError('AddUPI connection failed got Error code {code}: {msg} on {url}'
+                                  .format(url=r.url, **error.attrs))
+            return soup, r.url
+
+    async def get(self, params: dict) -> aiohttp.ClientResponse:
+        """
+        GETs self.url with params using the kept alive http session and checks the status
+        """
+        try:
+            r = await self.http.get(self.url, params=params)
+        except aiohttp.ServerDisconnectedError:
+            # The base station closed the kept alive connection meanwhile, retry with a new connection
+            r = await self.http.get(self.url, params=params)
+        # status check
+        if r.status // 100 > 2:
+            r.release()
+            raise AddUPIError('AddUPI connection failed, got status {} from {}'.format(r.status, r.url))
+        return r
+
+    async def stream(self, chunksize=0x10000, node_ids: typing.Optional[typing.Container[str]] = None,
+                     **params) -> typing.AsyncIterator[typing.Tuple[str, str, str]]:
+        """
+        Reads from self.url using the params and yields the values of a getdata response,
+        while the response is received. See :py:class:`DataStream`
+        :param chunksize: Size of the chunks fed into the parser
+        :param node_ids: The nodes, whose errors are logged, default all nodes of the response
+        :param params: A dictionary of parameters
+        :return: Async iterator of (node id, time string, value string)
+        """
+        if self.session and 'session-id' not in params:
+            params['session-id'] = self.session
+        stream = DataStream()
+        async with await self.get(params) as r:
+            try:
+                async for chunk in r.content.iter_chunked(chunksize):
+                    for value in stream.feed(chunk):
+                        yield value
+                stream.close()
+            except AddUPIError as e:
+                raise AddUPIError(f'{e} on {r.url}') from e
+            for node_id, error in stream.errors:
+                if node_ids is None or node_id in node_ids:
+                    logger.warning(f'{self}: error at node {node_id}: #{error.get("code")}: {error.get("msg")} ({r.url})')
 
     async def login(self, timeout=None):
         """
@@ -186,59 +381,182 @@ class Bus(base.Bus):
         self.sensors.append(asensor)
         return asensor
 
-    async def read_all(self) -> typing.List[base.Value]:
+    async def read_all(self) -> base.ValueBatch:
+        """
+        Reads all sensors concurrently, at most max_connections at a time.
+
+        A failing sensor is logged and does not stop the other sensors, the
+        error is raised only if all sensors fail.
+        :return: The values of all sensors in the order of the sensors
+        """
         if not self.session:
             raise AddUPIError('addupi.Bus.read_all: No log in session available')
-        values = []
-        for sensor in self.sensors:
-            s_values = await self.readsensor(sensor)
-            values.extend(s_values)
-        return values
+        semaphore = asyncio.Semaphore(self.max_connections)
+        partial = base.partial.get()
+
+        async def read(sensor):
+            async with semaphore:
+                values = await self.readsensor(sensor)
+            if partial is not None:
+                partial.update(values)
+            return values
+
+        results = await asyncio.gather(*[read(sensor) for sensor in self.sensors], return_exceptions=True)
+        errors = [(sensor, res) for sensor, res in zip(self.sensors, results) if isinstance(res, BaseException)]
+        for sensor, error in errors:
+            logger.warning(f'{self}: reading {sensor} failed with {error!r}')
+        if errors and len(errors) == len(results):
+            raise errors[0][1]
+        return base.ValueBatch.concat(*[res for res in results if not isinstance(res, BaseException)])
 
-    async def readsensor(self, sensor: Sensor, fromdate=None, slots=None) -> typing.List[base.Value]:
+    async def readsensor(self, sensor: Sensor, fromdate=None, slots=None) -> base.ValueBatch:
         """
         Reads a sensor
         :param sensor: AddUPISensor to read
-        :return: list of values (Value)
+        :return: the values as ValueBatch
         """
         if not self.session:
             raise AddUPIError('addupi.Bus.read_all: No log in session available')
 
+        params = self.getdata_params(sensor, fromdate, slots)
+        values = base.ValueBatch(sensor.valuefactories)
+        for vf, (times, rawvalues) in (await self.read_nodes(sensor, params)).items():
+            # Scale all values of the node at once
+            values.extend(vf, vf.scale_array(rawvalues), np.frombuffer(times, dtype=np.int64))
+        return values
+
+    async def readsensor_frame(self, sensor: Sensor, fromdate=None, slots=None) -> pd.DataFrame:
+        """
+        Reads a sensor into a DataFrame, eg. for the analysis of the history.
+
+        The values go from the response stream into numeric arrays and are scaled
+        per column, without creating an object per value.
+        :param sensor: AddUPISensor to read
+        :param fromdate: Start date of the history, if None only the last values are read
+        :param slots: Maximum number of values per node
+        :return: DataFrame with the time (UTC) as index and a column for each valuefactory
+        """
+        if not self.session:
+            raise AddUPIError('addupi.Bus.readsensor_frame: No log in session available')
+        nodes = await self.read_nodes(sensor, self.getdata_params(sensor, fromdate, slots))
+        columns = {
+            vf.name: pd.Series(vf.scale_array(rawvalues),
+                               index=pd.to_datetime(np.frombuffer(times, dtype=np.int64), unit='s'))
+            for vf, (times, rawvalues) in nodes.items()
+        }
+        names = [vf.name for vf in sensor.valuefactories]
+        if columns:
+            frame = pd.concat(columns, axis=1).reindex(columns=names)
+        else:
+            frame = pd.DataFrame(columns=names, index=pd.DatetimeIndex([]), dtype=float)
+        frame.index.name = 'time'
+        return frame
+
+    @staticmethod
+    def getdata_params(sensor: Sensor, fromdate=None, slots=None) -> dict:
+        """
+        The parameters of a getdata request for the sensor
+        """
         params = {'function': 'getdata',
                   'id': sensor.id}
         if fromdate:
             params['date'] = fromdate.strftime('%Y%m%dT%H:%M:%S')
             params['slots'] = slots or 1000
+        return params
 
-        soup, url = await self.read(**params)
-        # Check returned node_id
-        nodes = soup.response.find_all('node')
-        # Make an empty value list
-        values = []
-        # Make a dict to relate id's with valuefactory numbers
-        vfdict = dict((str(vf.id), i) for i, vf in enumerate(sensor.valuefactories))
-        for node in nodes:
-            # Get first value with absolute date
-            node_id = node['id']
+    async def read_nodes(self, sensor: Sensor, params: dict) -> typing.Dict[base.ValueFactory, typing.Tuple[array.array, array.array]]:
+        """
+        Streams a getdata response and collects the values of the sensor's nodes
+        :return: The times (epoch seconds) and raw values for each valuefactory with data
+        """
+        # Make a dict to relate id's with valuefactories
+        vfdict = dict((str(vf.id), vf) for vf in sensor.valuefactories)
+        # The time decoder, times and raw values of each node
+        nodes = {}
+        async for node_id, t_str, v_str in self.stream(node_ids=vfdict, **params):
             if node_id in vfdict:
-                if error := node.find('error', recursive=False):
-                    code = error.attrs.get('code')
-                    msg = error.attrs.get('msg')
-                    print(f'{datetime.datetime.now()}: Addupi warning at node {node_id}: #{code}: {msg} ({url})')
-                else:
-                    for v_elem in node('v', recursive=False):
-                        t_str = v_elem['t']
-                        try:
-                            t = datetime.datetime.strptime(t_str, '%Y%m%dT%H:%M:%S')
-                        except ValueError:
-                            if v_elem['t'].startswith('+'):
-                                t += datetime.timedelta(seconds=int(v_elem['t']))
-                            else:
-                                raise
-                        v = float(v_elem.string)
-                        # Check for relative time
-                        i = vfdict[node_id]
-                        values.append(sensor.valuefactories[i](v, t))
+                decode, times, rawvalues = nodes.setdefault(
+                    node_id, (TimeDecoder(), array.array('q'), array.array('d'))
+                )
+                times.append(decode(t_str))
+                rawvalues.append(float(v_str))
+        return {vfdict[node_id]: (times, rawvalues) for node_id, (decode, times, rawvalues) in nodes.items()}
 
+    async def backfill(self, since: datetime.datetime, onread: typing.Callable[[base.ValueBatch], typing.Any],
+                       checkpoint: typing.Union[str, base.Checkpoint, None] = None, slots: int = 1000,
+                       sensors: typing.Optional[typing.List[Sensor]] = None,
+                       until: typing.Optional[datetime.datetime] = None, concurrency: int = None) -> int:
+        """
+        Downloads the history of the sensors since a date, page by page.
 
-        return values
+        Each page holds at most `slots` values per node and is passed to onread, before the
+        high-water marks of its nodes are saved in the checkpoint. The next page is fetched
+        while onread handles the current one. The sensors are read concurrently, at most
+        max_connections at a time. An interrupted backfill resumes with the same checkpoint.
+        :param since: Start date of the download (UTC)
+        :param onread: Callback (or coroutine function) for each page as ValueBatch
+        :param checkpoint: File name or Checkpoint with the marks by node id, None to start from since each time
+        :param slots: The number of values per node of a page
+        :param sensors: The sensors to download, default all sensors of the bus
+        :param until: End date of the download (UTC, excluded), default is now
+        :param concurrency: Number of sensors read at the same time, default is max_connections
+        :return: The number of downloaded values
+        """
+        if not self.session:
+            raise AddUPIError('addupi.Bus.backfill: No log in session available')
+        marks = checkpoint if isinstance(checkpoint, base.Checkpoint) else base.Checkpoint(checkpoint)
+        semaphore = asyncio.Semaphore(concurrency or self.max_connections)
+        start = base.timestamp(since) - 1
+        end = base.timestamp(until) if until else float('inf')
+
+        async def backfill_sensor(sensor: Sensor) -> int:
+            node_ids = [str(vf.id) for vf in sensor.valuefactories]
+            count = 0
+            async with semaphore:
+                fromtime = min(marks.get(node_id, start) for node_id in node_ids)
+                task = asyncio.ensure_future(self.readsensor(sensor, base.fromtimestamp(fromtime + 1), slots))
+                try:
+                    while True:
+                        page = await task
+                        # Remove values already saved for nodes ahead of the others
+                        values = base.ValueBatch()
+                        last = {}
+                        # The newest time of each node with a full page, the others are complete
+                        full = []
+                        index, times, pagevalues = np.asarray(page.index), np.asarray(page.times), np.asarray(page.values)
+                        for n, vf in enumerate(page.factories):
+                            node = index == n
+                            if node.sum() >= slots:
+                                full.append(float(times[node].max()))
+                            new = node & (times > marks.get(str(vf.id), start)) & (times < end)
+                            if new.any():
+                                values.extend(vf, pagevalues[new], times[new])
+                                last[str(vf.id)] = float(times[new].max())
+                        # Fetch the next page from the full node with the oldest value, even if the page
+                        # had nothing new, eg. on resume or beside a node without data
+                        if full and min(full) + 1 < end:
+                            task = asyncio.ensure_future(
+                                self.readsensor(sensor, base.fromtimestamp(min(full) + 1), slots)
+                            )
+                        else:
+                            task = None
+                        if last:
+                            res = onread(values)
+                            if inspect.isawaitable(res):
+                                await res
+                            count += len(values)
+                            marks.advance(last)
+                            marks.save()
+                        if task is None:
+                            return count
+                finally:
+                    if task is not None:
+                        task.cancel()
+
+        tasks = [asyncio.ensure_future(backfill_sensor(sensor)) for sensor in sensors or self.sensors]
+        try:
+            return sum(await asyncio.gather(*tasks))
+        finally:
+            # Stop the other sensors, if one fails
+            for task in tasks:
+                task.cancel()
@@ -1,8 +1,16 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 import typing
 import importlib
 import yaml
-import collections
+import collections.abc
+import array
+import functools
+import math
+import ast
+import contextvars
+import os
+
+import numpy as np
 
 import logging
 logger = logging.getLogger(__name__)
@@ -11,6 +19,41 @@ class BusError(Exception):
     ...
 
 
+# Priority of the running read for shared resources like serial ports, lower numbers go first.
+# Set by the schedule to the interval of its time raster, hence fast rasters preempt slow ones
+priority: contextvars.ContextVar[float] = contextvars.ContextVar('priority', default=0)
+
+# Collects the values of each finished sensor while a bus is read. Set by the reader of the bus,
+# to keep the values of the finished sensors, if the read is cancelled at a deadline
+partial: contextvars.ContextVar[typing.Optional['ValueBatch']] = contextvars.ContextVar('partial', default=None)
+
+
+# math functions and their numpy ufuncs giving the same values. Other math functions differ
+# in numpy (eg. remainder is floor-modulo there) and are left out, so their code is not vectorized
+NUMPY_MATH = dict(
+    sin='sin', cos='cos', tan='tan', asin='arcsin', acos='arccos', atan='arctan', atan2='arctan2',
+    sinh='sinh', cosh='cosh', tanh='tanh', asinh='arcsinh', acosh='arccosh', atanh='arctanh',
+    exp='exp', expm1='expm1', log10='log10', log2='log2', log1p='log1p', sqrt='sqrt', pow='power',
+    fabs='fabs', floor='floor', ceil='ceil', trunc='trunc', fmod='fmod', hypot='hypot',
+    copysign='copysign', degrees='degrees', radians='radians',
+    isnan='isnan', isinf='isinf', isfinite='isfinite',
+)
+
+
+@functools.lru_cache()
+def numpy_math_namespace() -> dict:
+    """
+    The namespace for vectorized scale functions: the constants of the math module and the
+    numpy ufuncs of NUMPY_MATH. Any other math function raises a NameError
+    """
+    res = dict(pi=math.pi, e=math.e, tau=math.tau, inf=math.inf, nan=math.nan)
+    for name, npname in NUMPY_MATH.items():
+        res[name] = getattr(np, npname)
+    # math.log takes the base as optional second argument, np.log not
+    res['log'] = lambda x, base=None: np.log(x) if base is None else np.log(x) / np.log(base)
+    return res
+
+
 class ScaleFunction:
     """
     A user defined function to scale or translate a measured value into something meaningful
@@ -19,8 +62,9 @@ class ScaleFunction:
         if 'x' not in code:
             raise ValueError('Function code {} must include the variable x'.format(code))
         self.__code = code
+        self.__arrayfunction = None
+        self.vectorized = None  # Unknown until the first call of self.array
         try:
-            import math
             self.function = eval('lambda x:' + code, vars(math))
             if testvalue is not None:
                 self.function(testvalue)
@@ -31,6 +75,36 @@ class ScaleFunction:
     def __call__(self, x: float):
         return self.function(x)
 
+    def array(self, x: np.ndarray) -> np.ndarray:
+        """
+        Applies the function to an array of values with one numpy call.
+
+        The code is compiled once with numpy ufuncs in place of the math functions. Code that
+        can't be vectorized, like a lookup dict, falls back to calling the function per value.
+        :param x: An array of raw values
+        :return: An array of the scaled values
+        """
+        x = np.asarray(x)
+        if self.vectorized is not False:
+            try:
+                if self.__arrayfunction is None:
+                    self.__arrayfunction = eval('lambda x:' + self.__code, numpy_math_namespace())
+                with np.errstate(all='ignore'):
+                    res = np.asarray(self.__arrayfunction(x))
+                if res.shape != x.shape:
+                    raise ValueError(f'{self!r} changes the shape of the data')
+            except Exception as e:
+                logger.debug(f'{self!r} can not be vectorized: {e!r}')
+                self.vectorized = False
+            else:
+                self.vectorized = True
+                return res
+        return np.array([self.function(v) for v in x.tolist()])
+
+    def __reduce__(self):
+        # The compiled lambda can't be pickled, recompile from code
+        return type(self), (self.__code,)
+
     def __repr__(self):
         return "ScaleFunction('{}')".format(self.__code)
 
@@ -38,10 +112,109 @@ class ScaleFunction:
         return self.__code
 
 
-class Value(collections.UserDict):
+class LookupFunction(ScaleFunction):
+    """
+    A scale function translating a value with a lookup table, eg. for enum or status registers.
+
+    The table is built once, each call is a single index operation. The code of the function is
+    the table followed by [x], eg. {0: 'Off', 1: 'On'}[x], hence a ValueFactory with a LookupFunction
+    is saved and loaded like any other scale function.
+    """
+    # Maximum key for a dense numpy table used by self.array
+    max_dense_key = 4096
+
+    def __init__(self, table: typing.Union[typing.Mapping, str], testvalue=None):
+        """
+        :param table: A mapping or the code of a dict literal (with or without the trailing [x])
+        :param testvalue: A key to test the table
+        """
+        if isinstance(table, str):
+            code = table.strip()
+            if code.endswith('[x]'):
+                code = code[:-3].strip()
+            try:
+                table = ast.literal_eval(code)
+            except (ValueError, SyntaxError) as e:
+                raise ValueError('{} is not a valid lookup table, got error: {}'.format(code, repr(e)))
+        if not isinstance(table, typing.Mapping):
+            raise ValueError('A lookup table must be a dict, got {}'.format(table))
+        self.table = dict(table)
+        super().__init__(repr(self.table) + '[x]')
+        self.function = self.table.__getitem__
+        # Small non negative integer keys (the usual case for registers) get a dense table for arrays
+        if all(isinstance(k, int) and 0 <= k <= self.max_dense_key for k in self.table):
+            size = max(self.table, default=-1) + 1
+            self.dense = np.full(size, None, dtype=object)
+            self.defined = np.zeros(size, dtype=bool)
+            for k, v in self.table.items():
+                self.dense[k] = v
+                self.defined[k] = True
+        else:
+            self.dense = self.defined = None
+        if testvalue is not None:
+            self(testvalue)
+
+    @classmethod
+    def is_lookup(cls, code: str) -> bool:
+        """
+        Checks if the code of a scale function is a lookup in a dict literal. Other code with
+        the same shape, like a lookup in a dict comprehension, is left to ScaleFunction
+        """
+        code = code.strip()
+        if not (code.startswith('{') and code.endswith('}[x]')):
+            return False
+        try:
+            return isinstance(ast.literal_eval(code[:-3]), dict)
+        except (ValueError, SyntaxError, TypeError, MemoryError, RecursionError):
+            return False
+
+    def __call__(self, x):
+        return self.table[x]
+
+    def array(self, x: np.ndarray) -> np.ndarray:
+        """
+        Looks up an array of values at once. Raises a KeyError for values not in the table
+        """
+        x = np.asarray(x)
+        if self.dense is None:
+            return np.array([self.table[v] for v in x.tolist()], dtype=object)
+        with np.errstate(invalid='ignore'):
+            keys = x.astype(int)
+        inrange = (keys == x) & (keys >= 0) & (keys < len(self.dense))
+        if not inrange.all():
+            raise KeyError(x[~inrange][0])
+        undefined = ~self.defined[keys]
+        if undefined.any():
+            raise KeyError(x[undefined][0])
+        return self.dense[keys]
+
+    def __repr__(self):
+        return 'LookupFunction({!r})'.format(self.table)
+
+
+def make_scalefunction(code: typing.Union[str, ScaleFunction, None]) -> typing.Optional[ScaleFunction]:
+    """
+    Creates the fitting ScaleFunction for code, a LookupFunction for dict lookups
+    """
+    if isinstance(code, ScaleFunction):
+        return code
+    elif not code:
+        return None
+    elif LookupFunction.is_lookup(code):
+        return LookupFunction(code)
+    else:
+        return ScaleFunction(code)
+
+
+class Value(collections.abc.Mapping):
     """
-    A measured value with metadata
+    A measured value with metadata.
+
+    The metadata shared by all values of a ValueFactory is not copied, the value
+    keeps a reference to its factory instead
     """
+    __slots__ = ('value', 'time', 'name', 'unit', 'factory', '_extradata')
+
     def __init__(self, value, time=None, name=None, unit=None, **kwargs):
         """
         Creates the value with meta data
@@ -55,37 +228,74 @@ class Value(collections.UserDict):
         self.name = name
         self.time = time
         self.unit = unit
-        self.extradata = kwargs
+        self.factory = None
+        self._extradata = kwargs or None
+
+    @classmethod
+    def from_factory(cls, factory: 'ValueFactory', value, time, extradata: dict = None) -> 'Value':
+        """
+        Creates a value sharing name, unit and metadata with a ValueFactory
+        :param factory: The ValueFactory of the value
+        :param value: The (scaled) value
+        :param time: Time of measurement
+        :param extradata: Additional meta data for this value only, or None
+        """
+        self = cls.__new__(cls)
+        self.value = value
+        self.time = time
+        self.name = factory.name
+        self.unit = factory.unit
+        self.factory = factory
+        self._extradata = extradata or None
+        return self
+
+    @property
+    def extradata(self) -> dict:
+        """
+        The additional meta data of the value, including the meta data of the factory
+        """
+        if self.factory is None:
+            return dict(self._extradata or {})
+        res = self.factory.extradata.copy()
+        if self._extradata:
+            res.update(self._extradata)
+        return res
 
     def __str__(self):
         res = ''
         if self.name:
             res += self.name + '='
         res += '{:0.6g}'.format(self.value)
-        if hasattr(self, 'unit') and self.unit:
+        if self.unit:
             res += ' ' + str(self.unit)
         if self.time:
             res += self.time.strftime(' (%d.%m.%Y %H:%M:%S)')
         return res
 
     def __repr__(self):
-        res = 'name={name!r}, time={time!r}, value={value:0.4g}'.format(**vars(self))
-        if self.extradata:
-            res += ', ' + ', '.join('{!s}={!r}'.format(*it) for it in self.extradata.items())
+        res = 'name={!r}, time={!r}, value={:0.4g}'.format(self.name, self.time, self.value)
+        extradata = self.extradata
+        if extradata:
+            res += ', ' + ', '.join('{!s}={!r}'.format(*it) for it in extradata.items())
         return 'Value({})'.format(res)
 
     def __getattr__(self, item):
-        if item in self.extradata:
-            return self.extradata[item]
+        # Only called if item is not a set slot, look up the metadata
+        if item.startswith('_'):
+            # Private or special name (eg. __setstate__ while unpickling), avoid a recursion
+            raise AttributeError(item)
+        elif self._extradata and item in self._extradata:
+            return self._extradata[item]
+        elif self.factory is not None and item in self.factory.extradata:
+            return self.factory.extradata[item]
         else:
             raise AttributeError(f'{item} not an attribute of {self}')
 
-
     def __asdict__(self):
         """
         :return: The Value as a dictionary
         """
-        res = self.extradata.copy()
+        res = self.extradata
         res.update(dict(name=self.name, value=self.value, time=self.time.isoformat()))
         return res
 
@@ -93,6 +303,15 @@ class Value(collections.UserDict):
     def data(self):
         return self.__asdict__()
 
+    def __getitem__(self, item):
+        return self.data[item]
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
 
 class ValueFactory:
     """
@@ -109,12 +328,7 @@ class ValueFactory:
         """
         self.name = name
         self.unit = unit
-        if isinstance(scalefunction, ScaleFunction):
-            self.scalefunction = scalefunction
-        elif scalefunction:
-            self.scalefunction = ScaleFunction(scalefunction)
-        else:
-            self.scalefunction = None
+        self.scalefunction = make_scalefunction(scalefunction)
         self.extradata = kwargs
 
     def __asdict__(self) -> dict:
@@ -134,15 +348,39 @@ class ValueFactory:
         :param kwargs: Extra meta data to be stored with the value
         :return: Value
         """
+        return Value.from_factory(self, self.scale(value), time or datetime.utcnow(), kwargs)
+
+    def scale(self, value: float):
+        """
+        Applies the scalefunction (if any) to a raw value
+        :param value: the measured raw value
+        :return: the scaled value
+        """
         if self.scalefunction:
-            value = self.scalefunction(value)
-        time = time or datetime.utcnow()
-        data = self.extradata.copy()
-        data.update(kwargs)
-        return Value(value, time, self.name, unit=self.unit, **data)
+            return self.scalefunction(value)
+        else:
+            return value
+
+    def scale_array(self, values: typing.Sequence[float]) -> np.ndarray:
+        """
+        Applies the scalefunction (if any) to a sequence of raw values at once
+        :param values: the measured raw values
+        :return: the scaled values as a numpy array
+        """
+        values = np.asarray(values)
+        if values.dtype.kind not in 'iu':
+            # Integer values stay integer, eg. for bit masks of status registers
+            values = values.astype(float)
+        if self.scalefunction:
+            return self.scalefunction.array(values)
+        else:
+            return values
 
     def __getattr__(self, item):
-        if item in self.extradata:
+        if 'extradata' not in vars(self):
+            # extradata is not set yet (eg. while unpickling), avoid a recursion
+            raise AttributeError(item)
+        elif item in self.extradata:
             return self.extradata[item]
         else:
             raise AttributeError(f'{item} not an attribute of {self}')
@@ -160,6 +398,272 @@ class ValueFactory:
             name = self.name
         return '{name} [{self.unit}]'.format(name=name, self=self)
 
+EPOCH = datetime(1970, 1, 1)
+
+
+def timestamp(time: datetime) -> float:
+    """
+    Converts a datetime to seconds since 1970-01-01. Naive datetimes are taken as UTC,
+    like the times created by :py:meth:`ValueFactory.__call__`
+    """
+    if time.tzinfo:
+        return time.timestamp()
+    else:
+        return (time - EPOCH).total_seconds()
+
+
+def fromtimestamp(seconds: float) -> datetime:
+    """
+    Converts seconds since 1970-01-01 into a naive UTC datetime, the inverse of :py:func:`timestamp`
+    """
+    return EPOCH + timedelta(seconds=seconds)
+
+
+class ValueBatch:
+    """
+    A columnar collection of measured values.
+
+    Instead of one :py:class:`Value` per sample, the batch keeps the number of the
+    valuefactory, the time (seconds since 1970-01-01 UTC) and the value of each sample
+    in array columns. Name, unit and the other metadata are shared by the valuefactory.
+    Value objects are only created when the batch is iterated or indexed. The values are
+    a float column, an integer column if the batch starts with integer arrays (eg. Modbus
+    registers) or a list for other values, like texts from a lookup table.
+
+    Usage:
+    >>> batch = ValueBatch()
+    >>> batch.append(factory, factory.scale(raw), time)
+    >>> for v in batch:
+    >>>     print(v)
+    """
+
+    def __init__(self, factories: typing.Iterable[ValueFactory] = ()):
+        self.factories: typing.List[ValueFactory] = []
+        self.__factory_numbers = {}
+        # The columns
+        self.index = array.array('l')
+        self.times = array.array('d')
+        self.values: typing.Union[array.array, list] = array.array('d')
+        for factory in factories:
+            self.factory_number(factory)
+
+    def factory_number(self, factory: ValueFactory) -> int:
+        """
+        Returns the position of the factory in self.factories, adds the factory if needed
+        """
+        try:
+            return self.__factory_numbers[factory]
+        except KeyError:
+            n = self.__factory_numbers[factory] = len(self.factories)
+            self.factories.append(factory)
+            return n
+
+    def __extend_values(self, values):
+        n = len(self.values)
+        if isinstance(values, np.ndarray):
+            if isinstance(self.values, array.array):
+                if not n and values.dtype.kind in 'iu' and np.can_cast(values.dtype, 'q'):
+                    # Integer values keep an integer column
+                    self.values = array.array('q')
+                if self.values.typecode == 'd':
+                    fits = values.dtype.kind in 'fiub'
+                else:
+                    fits = np.can_cast(values.dtype, 'q')
+                if fits:
+                    # Copy the buffer at once instead of value by value
+                    self.values.frombytes(values.astype(self.values.typecode).tobytes())
+                    return
+            values = values.tolist()
+        elif isinstance(values, array.array) and isinstance(self.values, array.array):
+            if values.typecode != self.values.typecode:
+                values = values.tolist()
+        try:
+            self.values.extend(values)
+        except TypeError:
+            # Not a float, eg. a text from a lookup table or None. Continue with a list column
+            self.values = self.values[:n].tolist()
+            self.values.extend(values)
+
+    def append(self, factory: ValueFactory, value, time: datetime = None):
+        """
+        Adds a single (already scaled) value to the batch
+        :param factory: The valuefactory describing the value
+        :param value: The value
+        :param time: The time of measurement, if None, utcnow() is used
+        """
+        self.index.append(self.factory_number(factory))
+        self.times.append(timestamp(time or datetime.utcnow()))
+        self.__extend_values((value,))
+
+    def extend(self, factory: ValueFactory, values: typing.Sequence, times: typing.Sequence[float]):
+        """
+        Adds a series of (already scaled) values of one valuefactory to the batch
+        :param factory: The valuefactory describing the values
+        :param values: Sequence of values
+        :param times: Sequence of times as seconds since 1970-01-01 UTC, same length as values
+        """
+        if len(values) != len(times):
+            raise ValueError('ValueBatch.extend: {} values but {} times'.format(len(values), len(times)))
+        n = self.factory_number(factory)
+        self.index.extend(array.array('l', [n]) * len(values))
+        if isinstance(times, np.ndarray):
+            self.times.frombytes(times.astype('d').tobytes())
+        else:
+            self.times.extend(times)
+        self.__extend_values(values)
+
+    def extend_factories(self, factories: typing.Sequence[ValueFactory], values: typing.Sequence,
+                         time: datetime = None):
+        """
+        Adds one (already scaled) value for each of the factories, measured at the same time,
+        eg. all registers of a Modbus read
+        :param factories: The valuefactories describing the values
+        :param values: Sequence of values, same length as factories
+        :param time: The time of measurement, if None, utcnow() is used
+        """
+        if len(values) != len(factories):
+            raise ValueError('ValueBatch.extend_factories: {} values but {} factories'.format(len(values), len(factories)))
+        self.index.extend(array.array('l', [self.factory_number(f) for f in factories]))
+        self.times.extend(array.array('d', [timestamp(time or datetime.utcnow())]) * len(values))
+        self.__extend_values(values)
+
+    def update(self, other: 'ValueBatch'):
+        """
+        Appends all values of another batch to this batch
+        """
+        numbers = [self.factory_number(f) for f in other.factories]
+        self.index.extend(numbers[i] for i in other.index)
+        self.times.extend(other.times)
+        self.__extend_values(other.values)
+        return self
+
+    @classmethod
+    def from_values(cls, values: typing.Iterable['Value']) -> 'ValueBatch':
+        """
+        Creates a batch from Value objects, eg. returned by a bus not using batches
+        """
+        if isinstance(values, cls):
+            return values
+        batch = cls()
+        for v in values:
+            if v.factory is not None and not v._extradata:
+                factory = v.factory
+            else:
+                factory = ValueFactory(v.name, v.unit, **v.extradata)
+            batch.append(factory, v.value, v.time)
+        return batch
+
+    @classmethod
+    def concat(cls, *batches) -> 'ValueBatch':
+        """
+        Joins several batches (or lists of values) to a new batch
+        """
+        res = cls()
+        for b in batches:
+            res.update(cls.from_values(b))
+        return res
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, item: int) -> 'Value':
+        factory = self.factories[self.index[item]]
+        return Value.from_factory(factory, self.values[item], fromtimestamp(self.times[item]))
+
+    def __iter__(self) -> typing.Iterator['Value']:
+        for i in range(len(self)):
+            yield self[i]
+
+    def __add__(self, other):
+        return self.concat(self, other)
+
+    def __iadd__(self, other):
+        return self.update(self.from_values(other))
+
+    @property
+    def names(self) -> typing.List[str]:
+        return [self.factories[i].name for i in self.index]
+
+    @property
+    def units(self) -> typing.List[str]:
+        return [self.factories[i].unit for i in self.index]
+
+    def rows(self) -> typing.Iterator[typing.Tuple[str, datetime, typing.Any, str]]:
+        """
+        Yields name, time, value and unit of each sample without creating Value objects
+        """
+        for i, t, v in zip(self.index, self.times, self.values):
+            factory = self.factories[i]
+            yield factory.name, fromtimestamp(t), v, factory.unit
+
+    def columns(self) -> typing.Dict[str, typing.Sequence]:
+        """
+        :return: The batch as a dictionary of columns with the same keys as :py:meth:`Value.__asdict__`
+        """
+        keys = {}
+        for f in self.factories:
+            keys.update(dict.fromkeys(f.extradata))
+        res = {
+            key: [self.factories[i].extradata.get(key) for i in self.index]
+            for key in keys
+        }
+        res.update(dict(
+            name=self.names,
+            value=self.values,
+            time=[fromtimestamp(t).isoformat() for t in self.times]
+        ))
+        return res
+
+    def latest(self) -> typing.Dict[ValueFactory, float]:
+        """
+        The time of the newest value for each factory as seconds since 1970-01-01 UTC
+        """
+        index = np.asarray(self.index)
+        times = np.asarray(self.times)
+        return {
+            factory: float(times[index == n].max())
+            for n, factory in enumerate(self.factories)
+            if (index == n).any()
+        }
+
+    def __repr__(self):
+        return 'ValueBatch({} values of {} factories)'.format(len(self), len(self.factories))
+
+
+class Checkpoint(dict):
+    """
+    High-water marks: the time of the last saved value (epoch seconds) by a key,
+    eg. the node id of an AddUPI backfill or the sensor and value id of a logged value.
+
+    The checkpoint is stored as a yaml file and replaced atomically, hence an interrupted
+    download resumes after the last saved page.
+    """
+    def __init__(self, path: typing.Optional[str] = None):
+        """
+        :param path: The file of the checkpoint, loaded if it exists. None keeps the checkpoint in memory
+        """
+        super().__init__()
+        self.path = path
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.update(yaml.safe_load(f) or {})
+
+    def advance(self, marks: typing.Mapping[str, float]):
+        """
+        Moves the marks forward, older times are ignored
+        """
+        for key, t in marks.items():
+            if t > self.get(key, t - 1):
+                self[key] = t
+
+    def save(self):
+        if self.path:
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                yaml.safe_dump(dict(self), f)
+            os.replace(tmp, self.path)
+
+
 class Sensor:
     """
     Base class for a sensor on a bus
@@ -183,10 +687,10 @@ class Bus:
     async def readsensor(self, sensor):
         raise NotImplementedError
 
-    async def read_all(self) -> typing.List[Value]:
+    async def read_all(self) -> ValueBatch:
         """
         Reads all sensors
-        :return: A List of Values
+        :return: A ValueBatch (or a list of Values)
         """
         raise NotImplementedError
 
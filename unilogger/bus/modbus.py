@@ -1,10 +1,21 @@
 import asyncio
+import datetime
 import json
+import struct
+import typing
 
+import numpy as np
 from umodbus.client import tcp
 
 from . import base
 
+import logging
+logger = logging.getLogger(__name__)
+
+
+class ModbusConnectionError(base.BusError, ConnectionError):
+    pass
+
 
 class Sensor(base.Sensor):
     def __init__(self, mdbunit, startaddress, length, name=None, values=None, **kwargs):
@@ -47,9 +58,296 @@ async def send_message(adu, reader, writer):
     return tcp.parse_response_adu(response, adu)
 
 
+class Connection:
+    """
+    A persistent Modbus TCP connection with several transactions in flight.
+
+    Each request gets its own MBAP transaction id, a background task reads the responses
+    and hands them to the waiting request with the same id. The connection is opened on
+    the first transaction and reopened, if the gateway closed it.
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 5.0, max_transactions: int = 8):
+        """
+        :param host: Host name of the Modbus TCP server
+        :param port: TCP port
+        :param timeout: Timeout in seconds for connecting and for each transaction
+        :param max_transactions: Maximum number of transactions in flight
+        """
+        self.client = (host, port)
+        self.timeout = timeout
+        self.loop = asyncio.get_event_loop()
+        self.reader: typing.Optional[asyncio.StreamReader] = None
+        self.writer: typing.Optional[asyncio.StreamWriter] = None
+        self.receiver: typing.Optional[asyncio.Task] = None
+        self.pending: typing.Dict[int, asyncio.Future] = {}
+        self.transaction_id = 0
+        self.lock = asyncio.Lock()
+        self.semaphore = asyncio.Semaphore(max_transactions)
+
+    def __repr__(self):
+        return 'modbus.Connection({}:{}, {} pending)'.format(*self.client, len(self.pending))
+
+    @property
+    def connected(self) -> bool:
+        return (self.writer is not None and not self.writer.is_closing()
+                and self.receiver is not None and not self.receiver.done())
+
+    async def connect(self):
+        """
+        Opens the connection, if it is not open
+        """
+        async with self.lock:
+            if not self.connected:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.client), self.timeout
+                )
+                self.receiver = asyncio.ensure_future(self.receive())
+                logger.debug(f'{self}: connected')
+
+    async def receive(self):
+        """
+        Reads the response ADUs and resolves the pending transaction with the same id
+        """
+        try:
+            while True:
+                header = await self.reader.readexactly(7)
+                transaction_id, _, length, _ = struct.unpack('>HHHB', header)
+                pdu = await self.reader.readexactly(length - 1)
+                future = self.pending.pop(transaction_id, None)
+                if future and not future.done():
+                    future.set_result(header + pdu)
+                else:
+                    logger.warning(f'{self}: Response to unknown transaction {transaction_id}')
+        except (asyncio.IncompleteReadError, OSError) as e:
+            self.abort(ModbusConnectionError(f'Connection to {self.client} lost: {e!r}'))
+        except asyncio.CancelledError:
+            self.abort(ModbusConnectionError(f'Connection to {self.client} closed'))
+            raise
+
+    def abort(self, exception: Exception):
+        """
+        Closes the connection and fails all pending transactions with exception
+        """
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(exception)
+        self.pending.clear()
+        if self.writer:
+            self.writer.close()
+        self.writer = self.reader = None
+
+    async def close(self):
+        if self.receiver and not self.receiver.done():
+            self.receiver.cancel()
+            await asyncio.gather(self.receiver, return_exceptions=True)
+        self.abort(ModbusConnectionError(f'Connection to {self.client} closed'))
+
+    def next_transaction_id(self) -> int:
+        while True:
+            self.transaction_id = (self.transaction_id + 1) % 0x10000
+            if self.transaction_id not in self.pending:
+                return self.transaction_id
+
+    async def transaction(self, adu: bytes, retries: int = 1, raw: bool = False):
+        """
+        Sends a request ADU, eg. from umodbus.client.tcp.read_holding_registers, and waits for the response
+        :param adu: The request
+        :param retries: Number of retries with a new connection, if the connection got lost
+        :param raw: If True, the response ADU is returned unparsed
+        :return: The parsed response data or the response ADU
+        """
+        async with self.semaphore:
+            for attempt in range(retries + 1):
+                await self.connect()
+                transaction_id = self.next_transaction_id()
+                adu = struct.pack('>H', transaction_id) + adu[2:]
+                future = self.loop.create_future()
+                self.pending[transaction_id] = future
+                writer = self.writer
+                try:
+                    writer.write(adu)
+                    await writer.drain()
+                    response = await asyncio.wait_for(future, self.timeout)
+                except ConnectionError as e:
+                    if attempt >= retries:
+                        raise
+                    logger.info(f'{self}: {e!r}, reconnecting')
+                    if self.writer is writer:
+                        # Not yet aborted by the receiver or already reconnected by another transaction
+                        self.abort(e)
+                else:
+                    if raw:
+                        return response
+                    return tcp.parse_response_adu(response, adu)
+                finally:
+                    self.pending.pop(transaction_id, None)
+
+
+__connections: typing.Dict[typing.Tuple[str, int], Connection] = {}
+
+
+def get_connection(host: str, port: int, **kwargs) -> Connection:
+    """
+    Returns the pooled connection to host:port, for the running event loop
+    :param kwargs: Parameters for a new Connection
+    """
+    conn = __connections.get((host, port))
+    if conn is None or conn.loop is not asyncio.get_event_loop():
+        conn = __connections[host, port] = Connection(host, port, **kwargs)
+    return conn
+
+
+class ReadRequest(typing.NamedTuple):
+    """
+    A read_holding_registers request
+    """
+    mdbunit: int
+    startaddress: int
+    length: int
+
+    def adu(self) -> bytes:
+        return tcp.read_holding_registers(self.mdbunit, self.startaddress, self.length)
+
+
+class ReadPlan:
+    """
+    The minimal set of read_holding_registers requests to read the valuefactories of some sensors.
+
+    The registers of all sensors with the same mdbunit are sorted and merged into requests
+    of at most max_length registers. Registers further apart than max_gap are read with a
+    separate request, as reading the gap would cost more than another (pipelined) request.
+    The index relates each valuefactory to its request and the offset of the register in the response.
+
+    A valuefactory can declare the datatype of its register(s) with the datatype and wordorder fields:
+
+    - datatype: int16, uint16 (default), int32, uint32, float32 or float64
+    - wordorder: big (default, most significant register first) or little
+    """
+    # Maximum number of registers per read_holding_registers request (Modbus protocol limit)
+    max_length = 125
+
+    # numpy dtype and number of registers for the datatypes
+    datatypes = dict(
+        int16=('>i2', 1), uint16=('>u2', 1),
+        int32=('>i4', 2), uint32=('>u4', 2),
+        float32=('>f4', 2), float64=('>f8', 4),
+    )
+
+    def __init__(self, sensors: typing.Iterable[Sensor], max_gap: int = 8):
+        """
+        :param sensors: The sensors to read
+        :param max_gap: Maximum number of unused registers between two values in one request
+        """
+        sensors = list(sensors)
+        self.signature = self.get_signature(sensors)
+        self.max_gap = max_gap
+        self.requests: typing.List[ReadRequest] = []
+        # (valuefactory, request number, offset) in the order of the sensors
+        self.index: typing.List[typing.Tuple[base.ValueFactory, int, int]] = []
+
+        # Register ranges (start, end) per unit
+        ranges: typing.Dict[int, typing.Set[typing.Tuple[int, int]]] = {}
+        for sensor in sensors:
+            for vf in sensor.valuefactories:
+                ranges.setdefault(sensor.mdbunit, set()).add((vf.id, vf.id + self.register_count(vf)))
+
+        # Merge the ranges to requests
+        positions = {}
+        for mdbunit, unit_ranges in ranges.items():
+            start = end = None
+            for r_start, r_end in sorted(unit_ranges):
+                if start is None or r_start - end > max_gap or max(end, r_end) - start > self.max_length:
+                    if start is not None:
+                        self.requests.append(ReadRequest(mdbunit, start, end - start))
+                    start, end = r_start, r_end
+                else:
+                    end = max(end, r_end)
+                positions[mdbunit, r_start] = (len(self.requests), r_start - start)
+            self.requests.append(ReadRequest(mdbunit, start, end - start))
+
+        for sensor in sensors:
+            for vf in sensor.valuefactories:
+                self.index.append((vf,) + positions[sensor.mdbunit, vf.id])
+        self.factories = [vf for vf, _, _ in self.index]
+        # Values with an integer datatype, passed as int to the scale functions
+        self.integer = [np.dtype(self.datatype(vf)[0]).kind in 'iu' for vf in self.factories]
+
+        # Group the values of each request by datatype to decode them with one numpy operation per group
+        groups = {}
+        for position, (vf, request, offset) in enumerate(self.index):
+            offsets, targets = groups.setdefault((request,) + self.datatype(vf), ([], []))
+            offsets.append(offset)
+            targets.append(position)
+        # decoders per request: (dtype, register count, swap words, offsets, positions in index)
+        self.decoders: typing.List[typing.List[tuple]] = [[] for _ in self.requests]
+        for (request, dtype, count, swap), (offsets, targets) in groups.items():
+            self.decoders[request].append((dtype, count, swap, np.array(offsets), np.array(targets)))
+
+    @classmethod
+    def datatype(cls, vf: base.ValueFactory) -> typing.Tuple[str, int, bool]:
+        """
+        Returns the numpy dtype, the number of registers and if the words need to be swapped for a valuefactory
+        """
+        datatype = vf.extradata.get('datatype') or 'uint16'
+        wordorder = vf.extradata.get('wordorder') or 'big'
+        try:
+            dtype, count = cls.datatypes[datatype]
+        except KeyError:
+            raise ValueError(f'{vf}: Unknown Modbus datatype {datatype}, use one of {", ".join(cls.datatypes)}')
+        if wordorder not in ('big', 'little'):
+            raise ValueError(f'{vf}: wordorder must be big or little, not {wordorder}')
+        return dtype, count, wordorder == 'little' and count > 1
+
+    @classmethod
+    def register_count(cls, vf: base.ValueFactory) -> int:
+        """
+        Number of registers of a valuefactory
+        """
+        return cls.datatype(vf)[1]
+
+    @classmethod
+    def get_signature(cls, sensors: typing.Iterable[Sensor]) -> tuple:
+        """
+        Returns a key describing the registers of the sensors, to find out if a plan is still valid
+        """
+        return tuple(
+            (sensor.mdbunit, tuple((vf.id,) + cls.datatype(vf) for vf in sensor.valuefactories))
+            for sensor in sensors
+        )
+
+    def decode(self, responses: typing.Sequence[bytes]) -> np.ndarray:
+        """
+        Decodes the register data of the responses to the requests
+        :param responses: The register data (without header and byte count) for each request
+        :return: The raw values in the order of the index, as int64 if all datatypes are integers
+        """
+        res = np.empty(len(self.index), dtype=np.int64 if all(self.integer) else float)
+        for request, data, decoders in zip(self.requests, responses, self.decoders):
+            registers = np.frombuffer(data, dtype='>u2', count=request.length)
+            for dtype, count, swap, offsets, targets in decoders:
+                if count == 1:
+                    res[targets] = registers[offsets].view(dtype)
+                else:
+                    words = registers[offsets[:, np.newaxis] + np.arange(count)]
+                    if swap:
+                        words = words[:, ::-1]
+                    res[targets] = np.ascontiguousarray(words).view(dtype)[:, 0]
+        return res
+
+    def __len__(self):
+        return len(self.requests)
+
+    def __repr__(self):
+        return 'modbus.ReadPlan({} requests for {} values)'.format(len(self.requests), len(self.index))
+
+
 class Bus(base.Bus):
-    def __init__(self, host, port=512, sensors=None, **kwargs):
+    def __init__(self, host, port=512, sensors=None, timeout=5.0, max_gap=8, **kwargs):
         self.client = (host, port)
+        self.timeout = timeout
+        self.max_gap = max_gap
+        self.__plan: typing.Optional[ReadPlan] = None
         self.extradata = kwargs
         if sensors:
             self.sensors = [Sensor(**s) for s in sensors]
@@ -58,7 +356,7 @@ class Bus(base.Bus):
 
     def __asdict__(self):
         res = self.extradata.copy()
-        res.update(dict(host=self.client[0], port=self.client[1]))
+        res.update(dict(host=self.client[0], port=self.client[1], timeout=self.timeout, max_gap=self.max_gap))
         res['module'] = __name__
         res['sensors'] = []
         for s in self.sensors:
@@ -68,23 +366,69 @@ class Bus(base.Bus):
     def __str__(self):
         return 'ModbusTCP client on {} with {} sensors'.format(self.client[0], len(self.sensors))
 
+    @property
+    def connection(self) -> Connection:
+        """
+        The pooled connection to the Modbus TCP server
+        """
+        return get_connection(*self.client, timeout=self.timeout)
+
+    async def close(self):
+        """
+        Closes the pooled connection
+        """
+        await self.connection.close()
+
+    @property
+    def plan(self) -> ReadPlan:
+        """
+        The read plan for all sensors, created again when the sensors have changed
+        """
+        if self.__plan is None or self.__plan.signature != ReadPlan.get_signature(self.sensors):
+            self.__plan = ReadPlan(self.sensors, self.max_gap)
+            logger.debug(f'{self}: {self.__plan}')
+        return self.__plan
+
+    async def execute(self, plan: ReadPlan) -> base.ValueBatch:
+        """
+        Sends the requests of a read plan concurrently and scatters the registers to the valuefactories
+        """
+        responses = await asyncio.gather(*[
+            self.connection.transaction(request.adu(), raw=True)
+            for request in plan.requests
+        ])
+        time = datetime.datetime.utcnow()
+        data = []
+        for request, response in zip(plan.requests, responses):
+            tcp.raise_for_exception_adu(response)
+            # Skip MBAP header, function code and byte count
+            data.append(memoryview(response)[9:9 + 2 * request.length])
+        raw = plan.decode(data)
+        values = raw
+        scaled = [position for position, vf in enumerate(plan.factories) if vf.scalefunction]
+        if scaled:
+            # Scale only the values with a scale function, the others go to the batch as decoded
+            values = raw.astype(object)
+            for position in scaled:
+                x = raw[position].item()
+                values[position] = plan.factories[position].scale(int(x) if plan.integer[position] else x)
+            if raw.dtype.kind == 'i' and all(isinstance(v, int) for v in values):
+                values = values.astype(np.int64)
+        batch = base.ValueBatch()
+        batch.extend_factories(plan.factories, values, time)
+        return batch
+
     async def readsensor(self, sensor: Sensor):
         """
         Reads a single sensor
         """
-        r, w = await asyncio.open_connection(*self.client)
-        msg = tcp.read_holding_registers(sensor.mdbunit, sensor.startaddress, sensor.length)
-        resp = await send_message(msg, r, w)
-        w.close()
-        
-        return [vf(resp[vf.id-sensor.startaddress]) for vf in sensor.valuefactories]
+        return await self.execute(ReadPlan([sensor], self.max_gap))
 
-    async def read_all(self):
-        values = []
-        for sensor in self.sensors:
-            s_values = await self.readsensor(sensor)
-            values.extend(s_values)
-        return values
+    async def read_all(self) -> base.ValueBatch:
+        """
+        Reads all sensors with the minimal number of requests over the pooled connection
+        """
+        return await self.execute(self.plan)
 
     def sensors_from_csv(self, filename):
         """
@@ -115,7 +459,7 @@ class Bus(base.Bus):
                 id = int(ls[3].strip())
                 # Get the scale function. When the unit is wrapped by braces, assume a lookup dict in the unit
                 if unit.strip().startswith('{') and unit.strip().endswith('}'):
-                    scalefunction = base.ScaleFunction(unit.strip() + '[x]', testvalue=None)
+                    scalefunction = base.LookupFunction(unit.strip())
                     unit = ''
                 elif ls[5]:
                     scalefunction = base.ScaleFunction('x / ' + ls[5].strip())
@@ -7,9 +7,15 @@ from . import base
 import aioserial
 import asyncio
 import datetime
-from attrdict import AttrDict
-from typing import List
+import typing
+from typing import List, Optional, Dict
 import contextlib
+import heapq
+import itertools
+import os
+import time
+
+import numpy as np
 
 import warnings
 
@@ -31,7 +37,38 @@ def decode(bytestring: bytes) -> str:
     :param bytestring:
     :return:
     """
-    return bytestring.decode()
+    return bytestring.decode(errors='replace')
+
+
+class SDI12Error(base.BusError):
+    pass
+
+
+class SDI12CRCError(SDI12Error):
+    pass
+
+
+def _crc16_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16(data: bytes, crc: int = 0) -> int:
+    """
+    The CRC-16 (polynomial 0xA001, initial value 0) used by SDI12 for CRC and binary responses
+    """
+    table = CRC16_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xFF]
+    return crc
 
 
 class parser:
@@ -67,24 +104,351 @@ class parser:
             except (ValueError, TypeError):
                 yield None
 
+    @staticmethod
+    def crc_chars(crc: int) -> str:
+        """
+        Encodes a CRC-16 as the three ASCII characters appended to SDI12 responses in CRC mode
+        """
+        return chr(0x40 | (crc >> 12)) + chr(0x40 | ((crc >> 6) & 0x3F)) + chr(0x40 | (crc & 0x3F))
+
+    @staticmethod
+    def check_crc(response: str) -> str:
+        """
+        Checks the CRC of a response to a data command in CRC mode (after aMC!, aCC!, aRCn!)
+        :param response: The response, eg. a+1.23+4.5Ibx<CR><LF>
+        :return: The response without the CRC and line end
+        """
+        response = response.rstrip('\r\n')
+        data, crc = response[:-3], response[-3:]
+        if len(response) < 4 or parser.crc_chars(crc16(encode(data))) != crc:
+            raise SDI12CRCError(f'SDI12 CRC mismatch in {response!r}')
+        return data
+
+    # numpy dtypes of the binary data types 1-10, 0 means an invalid request
+    binary_types = {
+        1: '<i1', 2: '<u1', 3: '<i2', 4: '<u2', 5: '<i4',
+        6: '<u4', 7: '<i8', 8: '<u8', 9: '<f4', 10: '<f8',
+    }
+
+    @staticmethod
+    def B(packet: bytes, out: np.ndarray, start: int = 0) -> int:
+        """
+        Decodes the binary packet returned by an SDI12 aDBn! command into an array
+
+        Packet layout: address (1 byte), size of the data (2 bytes), data type (1 byte),
+        data (size bytes), CRC-16 of all preceding bytes (2 bytes), all little endian.
+        :param packet: The complete packet
+        :param out: The array to write the values to
+        :param start: Position in out for the first value
+        :return: Number of values written, 0 for an empty packet or an invalid request
+        """
+        if len(packet) < 6:
+            raise SDI12Error(f'SDI12 binary packet too short: {packet!r}')
+        size = int.from_bytes(packet[1:3], 'little')
+        datatype = packet[3]
+        if len(packet) != size + 6:
+            raise SDI12Error(f'SDI12 binary packet of {len(packet)} bytes, expected {size + 6}')
+        if crc16(packet[:-2]) != int.from_bytes(packet[-2:], 'little'):
+            raise SDI12CRCError(f'SDI12 binary packet CRC mismatch: {packet!r}')
+        if datatype == 0 or size == 0:
+            return 0
+        try:
+            dtype = np.dtype(parser.binary_types[datatype])
+        except KeyError:
+            raise SDI12Error(f'Unknown SDI12 binary data type {datatype}')
+        data = np.frombuffer(packet, dtype=dtype, count=size // dtype.itemsize, offset=4)
+        n = min(len(data), len(out) - start)
+        out[start:start + n] = data[:n]
+        return n
+
+
+class PortLock:
+    """
+    Arbitrates the access to a physical serial port between all buses and schedules of the process.
+
+    Waiting users get the port in the order of their priority (:py:data:`base.priority`,
+    lower numbers first), users with the same priority first come, first served. As the port
+    is locked per command, a fast schedule overtakes a running slow read at the next command.
+
+    Usage:
+    >>> async with port_lock('/dev/ttyUSB0'):
+    >>>     ...
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.busy = False
+        self.waiting: List[typing.Tuple[float, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+        # priority -> [count, total wait time, max wait time]
+        self.wait_times: Dict[float, List[float]] = {}
+
+    def locked(self) -> bool:
+        return self.busy
+
+    async def acquire(self, record: bool = True):
+        """
+        Waits for the port
+        :param record: If False, the wait time is not recorded in the statistics, eg. for polling
+        """
+        priority = base.priority.get()
+        start = time.monotonic()
+        if self.busy or self.waiting:
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self.waiting, (priority, next(self.counter), future))
+            try:
+                await future
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    # The port was handed over after the cancellation, pass it on
+                    self.release()
+                raise
+        else:
+            self.busy = True
+        if record:
+            wait = time.monotonic() - start
+            stat = self.wait_times.setdefault(priority, [0, 0.0, 0.0])
+            stat[0] += 1
+            stat[1] += wait
+            stat[2] = max(stat[2], wait)
+            if wait > 1:
+                logger.debug(f'{self.name}: waited {wait:0.2f}s with priority {priority}')
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def release(self):
+        """
+        Hands the port over to the waiting user with the highest priority
+        """
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.busy = False
+
+    def statistics(self) -> Dict[float, dict]:
+        """
+        :return: The number, mean and maximum of the queue wait times in seconds by priority
+        """
+        return {
+            priority: dict(count=count, mean=total / count, max=maximum)
+            for priority, (count, total, maximum) in sorted(self.wait_times.items())
+        }
+
+    def __repr__(self):
+        return f'PortLock({self.name}, busy={self.busy}, waiting={len(self.waiting)})'
+
+
+# Locks and open ports of the process by device path
+__locks: Dict[str, PortLock] = {}
+__ports: Dict[str, 'SDI12port'] = {}
+
+
+def port_lock(port: str) -> PortLock:
+    """
+    Returns the lock of the physical port, shared by all handles of the device
+    """
+    path = os.path.realpath(port)
+    return __locks.setdefault(path, PortLock(path))
+
+
+def open_port(port: str, **kwargs) -> 'SDI12port':
+    """
+    Returns the shared handle of the serial port and opens it, if needed.
+    Each call must be paired with :py:func:`release_port`
+    :param port: The device name of the serial port
+    :param kwargs: Parameters for a new SDI12port
+    """
+    path = os.path.realpath(port)
+    serial = __ports.get(path)
+    if serial is None or not serial.is_open:
+        serial = __ports[path] = SDI12port(port, **kwargs)
+    serial.users += 1
+    return serial
+
+
+def release_port(serial: 'SDI12port'):
+    """
+    Releases a handle from :py:func:`open_port`, the port is closed when it is not used anymore
+    """
+    serial.users -= 1
+    if serial.users <= 0:
+        serial.close()
+        path = os.path.realpath(serial.port)
+        if __ports.get(path) is serial:
+            del __ports[path]
+
+
+def port_statistics() -> Dict[str, Dict[float, dict]]:
+    """
+    :return: The queue wait times of all serial ports, see :py:meth:`PortLock.statistics`
+    """
+    return {path: lock.statistics() for path, lock in __locks.items()}
+
 
 class SDI12port(aioserial.AioSerial):
-    def __init__(self, port, **kwargs):
-        super().__init__(port, **kwargs)
-        self.lock = asyncio.Lock()
+    """
+    A serial port with a SDI12 adapter. Commands are written with a call and return
+    as soon as the response line is complete.
+    """
+    # Interval in seconds to check the deadline while waiting for a response
+    poll_interval = 0.05
 
-    async def __call__(self, cmd: str) -> str:
+    def __init__(self, port, timeout=0.5, **kwargs):
+        """
+        :param port: The device name of the serial port
+        :param timeout: The default deadline for a response in seconds
+        :param kwargs: Further arguments for the serial port, eg. baudrate
+        """
+        super().__init__(port, timeout=self.poll_interval, **kwargs)
+        self.response_timeout = timeout
+        # Shared with all other handles of the device, see open_port
+        self.lock = port_lock(port)
+        self.users = 0
+        # Events for sensors expecting to send a service request (address -> Event)
+        self.service_requests: Dict[str, asyncio.Event] = {}
+        # Received bytes not yet framed as a line, see read_response
+        self.partial = b''
+
+    async def read_response(self, timeout: float) -> bytes:
+        """
+        Reads until the end of the line or until the timeout has passed.
+
+        Starts with the bytes kept in self.partial. Only the first line is returned,
+        bytes after its end (eg. a service request arriving with the response) are kept
+        in self.partial for the next read.
+        :param timeout: Time in seconds to wait for the complete line
+        :return: The line, may be incomplete or empty if the deadline passed
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        line = bytearray(self.partial)
+        self.partial = b''
+        while b'\n' not in line and loop.time() < deadline:
+            # Returns with the waiting bytes or after poll_interval
+            line += await self.read_async(max(1, self.in_waiting))
+        end = line.find(b'\n') + 1
+        if end:
+            self.partial = bytes(line[end:])
+            del line[end:]
+        return bytes(line)
+
+    async def __call__(self, cmd: str, timeout: float = None) -> str:
         """
         Writes string cmd to serial port and return the response as string
-        :param cmd:
-        :return:
+        :param cmd: The SDI12 command
+        :param timeout: Deadline for the response in seconds, default is the response_timeout of the port
+        :return: The response, empty if the sensor did not answer in time
         """
-        with await self.lock:
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            # Drop late answers to earlier commands, but keep their service requests
+            self.dispatch(self.partial + self.read(self.in_waiting))
+            self.partial = b''
             await self.write_async(encode(cmd + '\n'))
-            # SDI 12 is slow, let some time pass until looking for a result
-            await asyncio.sleep(0.1)
-            line = await self.readline_async()
-            return decode(line)
+            deadline = loop.time() + (timeout or self.response_timeout)
+            while True:
+                line = await self.read_response(deadline - loop.time())
+                # A service request of another sensor may arrive before the response
+                if not self.dispatch(line, ignore=cmd[:1]):
+                    return decode(line)
+
+    async def read_exactly(self, size: int, deadline: float) -> bytes:
+        """
+        Reads size bytes or less, if the deadline (in loop time) passed
+        """
+        loop = asyncio.get_running_loop()
+        data = bytearray()
+        while len(data) < size and loop.time() < deadline:
+            data += await self.read_async(size - len(data))
+        return bytes(data)
+
+    async def binary(self, cmd: str, timeout: float = None) -> bytes:
+        """
+        Writes a command with a binary response (aDBn!) and returns the packet
+        :param cmd: The SDI12 command
+        :param timeout: Deadline for the response in seconds, default is the response_timeout of the port
+        :return: The packet, may be incomplete if the sensor did not answer in time
+        """
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            self.dispatch(self.partial + self.read(self.in_waiting))
+            self.partial = b''
+            await self.write_async(encode(cmd + '\n'))
+            deadline = loop.time() + (timeout or self.response_timeout)
+            # address, packet size, data type
+            header = await self.read_exactly(4, deadline)
+            if len(header) < 4:
+                return header
+            size = int.from_bytes(header[1:3], 'little')
+            # data and CRC
+            return header + await self.read_exactly(size + 2, deadline)
+
+    def dispatch(self, data: bytes, ignore: str = None) -> bool:
+        """
+        Sets the events of service requests (a<CR><LF>) in data
+        :param data: Received bytes
+        :param ignore: An address that is not a service request, but the response to a command
+        :return: True if data contained only complete service requests
+        """
+        found = False
+        for line in data.splitlines(keepends=True):
+            address = decode(line).strip()
+            if line.endswith(b'\n') and address != ignore and address in self.service_requests:
+                logger.debug(f'SDI12.{address}: service request')
+                self.service_requests[address].set()
+                found = True
+            elif line.strip():
+                return False
+        return found
+
+    def expect_service_request(self, address: str):
+        """
+        Registers a sensor, that will send a service request, before the measurement command is sent
+        """
+        self.service_requests[address] = asyncio.Event()
+
+    async def wait_service_request(self, address: str, timeout: float) -> bool:
+        """
+        Waits until the sensor at address sends a service request or timeout has passed.
+
+        The port is only listened to, while it is not used by other commands, hence
+        commands for other sensors can interleave and dispatch the service request meanwhile
+        :param address: Address of the sensor, registered with :meth:`expect_service_request`
+        :param timeout: Maximum time to wait in seconds (ttt of the response to aM!)
+        :return: True if the service request arrived, False if the timeout passed
+        """
+        event = self.service_requests.setdefault(address, asyncio.Event())
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        try:
+            while not event.is_set() and loop.time() < deadline:
+                interval = min(deadline - loop.time(), self.poll_interval)
+                if self.lock.locked():
+                    # The running command reads the port and dispatches the service request
+                    with contextlib.suppress(asyncio.TimeoutError):
+                        await asyncio.wait_for(event.wait(), interval)
+                else:
+                    # Listening is polling, not a queued command, keep it out of the wait statistics
+                    await self.lock.acquire(record=False)
+                    try:
+                        data = await self.read_response(interval)
+                        if data.endswith(b'\n'):
+                            self.dispatch(data)
+                        else:
+                            # Keep the incomplete line for the next read
+                            self.partial = data + self.partial
+                    finally:
+                        self.lock.release()
+            return event.is_set()
+        finally:
+            self.service_requests.pop(address, None)
 
     def __enter__(self):
         return self
@@ -99,15 +463,37 @@ class Sensor(base.Sensor):
     SDI12 connector
     """
 
-    def __init__(self, channel, name, values, **kwargs):
+    # Measurement modes and their start command
+    modes = {
+        'concurrent': 'C', 'measurement': 'M', 'continuous': None,
+        'high-volume': 'HA', 'high-volume-binary': 'HB',
+    }
+
+    def __init__(self, channel, name, values, mode='concurrent', crc=False, max_retries=2, **kwargs):
         """
         Creates a new SDI12device from the response to the aI! string
         :bus: the SDI12bus this device belongs to.
         :info: A string line response from the SDI12 aI! command
         :config: A list of dictionaries
+        :mode: concurrent (aC!, wait the full time), measurement (aM!, wait for the service request)
+               or continuous (aR0!, no start command and no wait, the sensor must measure continuously)
+               high-volume (aHA!, up to 999 values with aD0!..aD999!)
+               high-volume-binary (aHB!, up to 999 values in binary packets with aDB0!..aDB999!)
+        :crc: If True, the measurement is started in CRC mode (aCC!, aMC!, aRCn!) and each
+              data response is checked. High volume ASCII responses and binary packets always
+              carry a CRC and are always checked
+        :max_retries: How often a failing data command is repeated
         """
         self.channel = channel
         self.name = name
+        if mode not in self.modes:
+            raise ValueError(f'SDI12 sensor {name}: mode must be one of {", ".join(self.modes)}, not {mode}')
+        self.mode = mode
+        self.crc = crc
+        self.max_retries = max_retries
+        # Counters for the data quality
+        self.retry_count = 0
+        self.crc_error_count = 0
         self.extradata = kwargs
         self.valuefactories: List[base.ValueFactory] = [
             base.ValueFactory(**v)
@@ -126,45 +512,166 @@ class Sensor(base.Sensor):
         Starts an asynchronous measurement of the device and returns
         a task to read the measurement later with :meth:`unilogger.bus.sdi12.Sensor.read_measurement`
 
-        SDI-Command sent: aC!
-        SDI-Command of the Task: aD0!, if necessary also aD1! etc.
+        SDI-Command sent: aC! (or aM!, aHA!, aHB! depending on the mode, nothing in continuous mode)
+        SDI-Command of the Task: aD0!, if necessary also aD1! etc. (aR0!, aR1! etc. in continuous mode)
 
         :param serial: The SDI12 port
         :return: asyncio.Task to write aDX! commands
         """
-        response = await serial(self.channel + 'C!\r\n')
+        command = self.modes[self.mode]
+        if self.mode == 'continuous':
+            return asyncio.create_task(self.read_continuous(serial))
+        elif self.crc_mode:
+            command += 'C'
+        if self.mode == 'measurement':
+            # Register before the command, the service request may follow the response quickly
+            serial.expect_service_request(self.channel)
+        response = await serial(self.channel + command + '!\r\n')
         # get wait time and number of values for this device
         wait, nvalues = parser.M(response)
-        logging.debug(f'SDI12.{self.channel}C: {nvalues} values in {wait}s')
+        logging.debug(f'SDI12.{self.channel}{command}: {nvalues} values in {wait}s')
         return asyncio.create_task(self.read_measurement(serial, wait, nvalues))
 
-    async def read_measurement(self, serial: SDI12port, wait: float, nvalues: int) -> List[base.Value]:
+    async def read_measurement(self, serial: SDI12port, wait: float, nvalues: int) -> base.ValueBatch:
         """
         Wait the wait time and performs the D0 (get data) command
-        If necessary it calls also the D1, D2 etc commands
+        If necessary it calls also the D1, D2 etc commands.
+        In measurement mode, the wait ends early with the service request of the sensor.
         :param serial: Write coroutine
         :param wait: Wait time in seconds
         :param nvalues: Number of values
-        :return: A list of augmented Values
+        :return: A ValueBatch of the augmented values
         """
         tstart = datetime.datetime.utcnow()
-        await asyncio.sleep(wait)
-        # Get the values, probably spread over several D commands
+        if self.mode == 'measurement':
+            if await serial.wait_service_request(self.channel, wait):
+                logging.debug(f'SDI12.{self.channel}: data ready before {wait}s')
+        else:
+            await asyncio.sleep(wait)
+        if self.mode == 'high-volume-binary':
+            floatvalues = await self.read_binary(serial, nvalues)
+        else:
+            floatvalues = await self.read_data(serial, 'D', nvalues)
+        return self.make_batch(floatvalues, tstart)
+
+    async def read_continuous(self, serial: SDI12port) -> base.ValueBatch:
+        """
+        Reads the current values of a continuously measuring sensor with aR0!, aR1! etc.
+        :param serial: The SDI12 port
+        :return: A ValueBatch of the augmented values
+        """
+        tstart = datetime.datetime.utcnow()
+        floatvalues = await self.read_data(serial, 'RC' if self.crc_mode else 'R', len(self.valuefactories))
+        return self.make_batch(floatvalues, tstart)
+
+    @property
+    def crc_mode(self) -> bool:
+        """
+        True if the measurement is started in CRC mode (aCC!, aMC!, aRCn!)
+        """
+        return self.crc and self.mode in ('concurrent', 'measurement', 'continuous')
+
+    @property
+    def data_crc(self) -> bool:
+        """
+        True if the data responses carry a CRC, in CRC mode and always after aHA!
+        """
+        return self.crc_mode or self.mode == 'high-volume'
+
+    def parse_data(self, response: str) -> List[float]:
+        """
+        Parses and checks the response to a data command
+        :raises SDI12Error: If the CRC does not match or the response is not readable
+        """
+        if not response.strip():
+            raise SDI12Error(f'SDI12.{self.channel}: No response')
+        if self.data_crc:
+            response = parser.check_crc(response)
+        if not response.startswith(self.channel):
+            raise SDI12Error(f'SDI12.{self.channel}: Response {response!r} from another address')
+        values = list(parser.D(response))
+        if None in values:
+            raise SDI12Error(f'SDI12.{self.channel}: Invalid value in {response!r}')
+        return values
+
+    async def retry(self, command: str, send: typing.Callable, parse: typing.Callable):
+        """
+        Sends a data command and parses the response. Only this command is repeated
+        up to max_retries times, if the response is corrupt.
+        :param command: The SDI12 command
+        :param send: Coroutine function sending the command, eg. the port
+        :param parse: Function parsing the response, raising an SDI12Error if corrupt
+        :return: The parsed response or None if all attempts failed
+        """
+        for attempt in range(self.max_retries + 1):
+            response = await send(command)
+            try:
+                return parse(response)
+            except SDI12Error as e:
+                if isinstance(e, SDI12CRCError):
+                    self.crc_error_count += 1
+                if attempt < self.max_retries:
+                    self.retry_count += 1
+                    logger.debug(f'{e}, retry {command.strip()}')
+                else:
+                    logger.warning(f'{e}, giving up after {attempt + 1} attempts')
+        return None
+
+    async def read_data(self, serial: SDI12port, command: str, nvalues: int) -> List[float]:
+        """
+        Gets the values, probably spread over several data commands (aD0!..aD9! or aR0!..aR9!)
+        :param serial: The SDI12 port
+        :param command: D or R
+        :param nvalues: Number of expected values
+        :return: List of the values
+        """
         floatvalues = []
-        d = 0  # The D command number
-        # repeat the D commands as necessary
-        while len(floatvalues) < nvalues:
-            response = await serial('{}D{}!\r\n'.format(self.channel, d))
-            floatvalues.extend(parser.D(response))
-            d += 1
-        # Augment & transform the values
-        return [factory(x, time=tstart) for
-                factory, x in
-                zip(self.valuefactories, floatvalues)]
+        # High volume measurements have up to 1000 data commands
+        for d in range(1000 if self.mode == 'high-volume' else 10):
+            if len(floatvalues) >= nvalues:
+                break
+            values = await self.retry('{}{}{}!\r\n'.format(self.channel, command, d), serial, self.parse_data)
+            if not values:
+                logger.warning(f'SDI12.{self.channel}{command}{d}: no values')
+                break
+            floatvalues.extend(values)
+        return floatvalues
+
+    async def read_binary(self, serial: SDI12port, nvalues: int) -> np.ndarray:
+        """
+        Gets the values of a high volume binary measurement with aDB0!..aDB999!
+        :param serial: The SDI12 port
+        :param nvalues: Number of expected values
+        :return: Array of the values
+        """
+        values = np.full(nvalues, np.nan)
+        n = 0
+        for d in range(1000):
+            if n >= nvalues:
+                break
+            count = await self.retry('{}DB{}!\r\n'.format(self.channel, d), serial.binary,
+                                     lambda packet: parser.B(packet, values, n))
+            if not count:
+                logger.warning(f'SDI12.{self.channel}DB{d}: no values')
+                break
+            n += count
+        return values[:n]
+
+    def make_batch(self, floatvalues: typing.Sequence[float], time: datetime.datetime) -> base.ValueBatch:
+        """
+        Augments & transforms the values with the valuefactories
+        """
+        if isinstance(floatvalues, np.ndarray):
+            floatvalues = floatvalues.tolist()
+        batch = base.ValueBatch()
+        for factory, x in zip(self.valuefactories, floatvalues):
+            batch.append(factory, factory.scale(x), time)
+        return batch
 
     def __asdict__(self)->dict:
         res = self.extradata.copy()
-        res.update(dict(channel=self.channel, name=self.name, values=[]))
+        res.update(dict(channel=self.channel, name=self.name, mode=self.mode,
+                        crc=self.crc, max_retries=self.max_retries, values=[]))
         for vf in self.valuefactories:
             res['values'].append(vf.__asdict__())
         return res
@@ -173,9 +680,24 @@ class Sensor(base.Sensor):
 class SDI12Bus(base.Bus):
     """
     Talks to configured SDI12-Sensors at this SDI12-Bus
+
+    A bus can span several serial ports (eg. a station with several USB-SDI12 adapters).
+    Each port has its own list of sensors and the ports are read concurrently::
+
+        module: unilogger.bus.sdi12
+        ports:
+        - port: /dev/ttyUSB0
+          sensors: [...]
+        - port: /dev/ttyUSB1
+          sensors: [...]
     """
 
-    def __init__(self, port=None, sensors=None, **kwargs):
+    def __init__(self, port=None, sensors=None, ports=None, **kwargs):
+        """
+        :param port: The serial port of the sensors
+        :param sensors: List of dict, describing the sensors at port
+        :param ports: List of dict with port and sensors for further serial ports
+        """
         kwargs.pop('module', None)
 
         self.port = port
@@ -184,16 +706,50 @@ class SDI12Bus(base.Bus):
         self.extradata = kwargs
 
         self.port = port
+        self.serial: Optional[SDI12port] = None
 
         if sensors:
             self.sensors = [Sensor(**sensor_data) for sensor_data in sensors]
+        else:
+            self.sensors = []
+        # Busses for the further ports
+        self.ports: List[SDI12Bus] = [SDI12Bus(**port_data) for port_data in ports or []]
+        # Seconds for the acknowledgement (a!) of the last sensor found by scanchannel
+        self.ack_latency = 0.0
 
     @contextlib.contextmanager
     def open(self) -> SDI12port:
-        with SDI12port(self.port, timeout=self.timeout, baudrate=self.baudrate) as port:
-            yield port
+        """
+        Yields the serial port of the bus. The port stays open for the next use. If the
+        port fails, eg. when the USB adapter got reset, it is closed and opened again on the next use.
+        """
+        if self.serial is None or not self.serial.is_open:
+            if self.serial:
+                release_port(self.serial)
+            self.serial = open_port(self.port, timeout=self.timeout, baudrate=self.baudrate)
+        try:
+            yield self.serial
+        except OSError as e:
+            logger.warning(f'{self}: {e!r}, reopening the port with the next use')
+            # Close the port for all its users
+            self.serial.close()
+            self.close()
+            raise
+
+    def close(self):
+        """
+        Releases the serial port(s), a port shared with other buses stays open for them
+        """
+        if self.serial:
+            release_port(self.serial)
+            self.serial = None
+        for bus in self.ports:
+            bus.close()
 
     def __repr__(self):
+        if self.ports:
+            ports = [self.port] if self.port else []
+            return 'sdi12.Bus(ports={})'.format(', '.join(ports + [bus.port for bus in self.ports]))
         return 'sdi12.Bus(port={})'.format(self.port)
 
     async def change_address(self, old_adress, new_adress):
@@ -209,60 +765,86 @@ class SDI12Bus(base.Bus):
         :param kwargs: Extra data to describe the sensor
         :return: The created SDI12Sensor
         """
-        s = Sensor(channel, name, **kwargs)
-        if values:
-            errors = []
-            for v in values:
-                try:
-                    s.valuefactories.append(base.ValueFactory(**v))
-                except Exception as e:
-                    logging.warning(f'Problem with')
+        s = Sensor(channel, name, [], **kwargs)
+        for v in values or []:
+            try:
+                s.valuefactories.append(base.ValueFactory(**v))
+            except Exception as e:
+                logger.warning(f'SDI12.{channel}: Could not create value from {v}: {e!r}')
         return s
 
     def __asdict__(self):
         res = self.extradata.copy()
-        res.update(dict(port=self.port))
+        if self.port or not self.ports:
+            res.update(dict(port=self.port))
         res['module'] = __name__
-        res['sensors'] = []
-        for s in self.sensors:
-            res['sensors'].append(s.__asdict__())
+        if self.sensors or not self.ports:
+            res['sensors'] = []
+            for s in self.sensors:
+                res['sensors'].append(s.__asdict__())
+        if self.ports:
+            res['ports'] = []
+            for bus in self.ports:
+                port_data = bus.__asdict__()
+                del port_data['module']
+                res['ports'].append(port_data)
         return res
 
 
-    async def scanchannel(self, serial: SDI12port, channel: str) -> Sensor:
+    async def value_count(self, serial: SDI12port, channel: str) -> typing.Tuple[int, int]:
+        """
+        Gets the wait time and the number of values of a sensor from the metadata commands
+        aIC! or aIM! (SDI12 1.3), without starting a measurement. Older sensors are asked with aC!
+        :return: seconds to result, number of values
+        """
+        for command in ('IC', 'IM', 'C'):
+            response = (await serial(channel + command + '!\r\n')).strip()
+            if response.startswith(channel) and len(response) > 4:
+                try:
+                    return parser.M(response)
+                except RuntimeError:
+                    pass
+        raise SDI12Error(f'SDI12.{channel}: Could not get the number of values')
+
+    async def scanchannel(self, serial: SDI12port, channel: str, timeout: float = None) -> Optional[Sensor]:
         """
         Reads on the specified SDI12 channel to create a sdi12.Sensor
 
         :param serial: SDI12port instance
         :param channel: SDI12 channel ('0'..'9', 'a'..'z','A'..'Z')
-        :return:
+        :param timeout: Time to wait for the acknowledgement of a sensor
+        :return: The sensor or None, if no sensor answered
         """
-
-        logging.info('Channel: ', channel, end='\n')
+        logger.debug(f'Channel: {channel}')
 
         # Check channel with Acknowledge Active Command
-        response = await serial(channel + '!\r\n')
+        loop = asyncio.get_running_loop()
+        tstart = loop.time()
+        response = await serial(channel + '!\r\n', timeout)
         if response.strip() == channel:
+            self.ack_latency = loop.time() - tstart
             name = (await serial(channel + 'I!\r\n')).strip()
-            logging.info(f'{channel} -> {name}')
-            # Get number of values with C command to add valuefactories
-            response = await serial(channel + 'C!\r\n')
-            wait, nvalues = parser.M(response)
+            logger.info(f'{channel} -> {name}')
+            wait, nvalues = await self.value_count(serial, channel)
             # Get valuefactory stubs
-            valuefactories = [
-                base.ValueFactory(name='Value_{:02d}'.format(i), id=i)
+            values = [
+                dict(name='Value_{:02d}'.format(i), id=i)
                 for i in range(nvalues)
             ]
-            logging.info(f'     {nvalues} values in {wait} seconds')
-            return self.makesensor(channel, name, valuefactories, scantime=wait)
+            logger.info(f'     {nvalues} values in {wait} seconds')
+            return self.makesensor(channel, name, values, scantime=wait)
 
         elif response.strip():
             warnings.warn('Queried channel {} but got {} as answer'.format(channel, response.strip()))
 
-    async def scanbus(self, channels=parser.channels) -> List[Sensor]:
+    async def scanbus(self, channels=parser.channels, timeout: float = 0.15) -> List[Sensor]:
         """
         Scans the SDI12 bus on the channels and creates sensor stubs
+
+        Empty addresses cost only a short timeout. It adapts to three times the slowest
+        acknowledgement of a found sensor, but not longer than the timeout of the bus.
         :param channels: A string of channel characters
+        :param timeout: The initial timeout for the acknowledgement of a sensor
         :return: List of detected sensors
 
         Usage:
@@ -272,34 +854,90 @@ class SDI12Bus(base.Bus):
         >>> for v in values:
         >>>     print(v)
         """
-        with SDI12port(self.port, timeout=self.timeout, baudrate=self.baudrate) as serial:
+        with self.open() as serial:
             sensors = []
             for c in channels:
-                sensor = await self.scanchannel(serial, c)
+                sensor = await self.scanchannel(serial, c, timeout)
                 if sensor:
+                    timeout = min(max(timeout, 3 * self.ack_latency), self.timeout)
                     sensors.append(sensor)
             return sensors
 
     async def read_all(self):
         """
-        Reads all sensors concurrently
+        Reads all sensors concurrently, the ports of a bus are read concurrently
         :return:
         """
-        return await self.readsensor(*self.sensors)
-
+        return await self.readsensor(*self.sensors, *[s for bus in self.ports for s in bus.sensors])
 
     async def readsensor(self, *sensors):
         """
         Reads the given sensor(s)
         :param sensors: SDI12 sensor objects
-        :return: List of Value objects created by the sensors valuefactories
+        :return: ValueBatch of the values created by the sensors valuefactories, grouped by port
+        """
+        if self.ports:
+            # Read each port concurrently with its own lock, the slowest port bounds the time
+            tasks = [
+                bus._read_port(*[s for s in sensors if s in bus.sensors])
+                for bus in [self] + self.ports
+                if any(s in bus.sensors for s in sensors)
+            ]
+            return base.ValueBatch.concat(*await asyncio.gather(*tasks))
+        return await self._read_port(*sensors)
+
+    async def _read_port(self, *sensors):
+        """
+        Reads the given sensor(s) at the port of this bus, without the further ports
         """
+        if not sensors:
+            return base.ValueBatch()
+        partial = base.partial.get()
+
+        def collect(task: asyncio.Task):
+            if partial is not None and not task.cancelled() and not task.exception():
+                partial.update(task.result())
+
         with self.open() as serial:
-            # Storages for wait and value numbers
-            tasklist = [(await s.do_measurement(serial)) for s in sensors]
+            # Start the measurements first, continuous sensors are read while the others measure
+            tasks = {}
+            try:
+                for s in sorted(sensors, key=lambda s: s.mode == 'continuous'):
+                    tasks[s] = await s.do_measurement(serial)
+                    tasks[s].add_done_callback(collect)
 
-            # Get the data from the sensors
-            values = await asyncio.gather(*tasklist)
-            return sum(values, [])  # slow but acceptable way to flatten list of lists
+                # Get the data from the sensors
+                values = await asyncio.gather(*[tasks[s] for s in sensors])
+            finally:
+                # Stop the started sensors, if the read failed or got cancelled
+                for task in tasks.values():
+                    task.cancel()
+            return base.ValueBatch.concat(*values)
 
 
+async def scan(*ports: str, channels: str = parser.channels, timeout: float = 0.15) -> SDI12Bus:
+    """
+    Scans several serial ports concurrently for SDI12 sensors
+    :param ports: The device names of the serial ports
+    :param channels: The channels to scan on each port
+    :param timeout: The initial timeout for empty addresses, see :py:meth:`SDI12Bus.scanbus`
+    :return: A bus with the detected sensors, spanning all ports with sensors
+
+    Usage:
+    >>> asyncio.run(scan('/dev/ttyUSB0', '/dev/ttyUSB1')).to_stream(sys.stdout)
+    """
+    busses = [SDI12Bus(port) for port in ports]
+
+    async def scan_port(bus: SDI12Bus):
+        try:
+            bus.sensors = await bus.scanbus(channels, timeout)
+        finally:
+            bus.close()
+        return bus
+
+    busses = [bus for bus in await asyncio.gather(*[scan_port(bus) for bus in busses]) if bus.sensors]
+    if len(busses) == 1:
+        return busses[0]
+    result = SDI12Bus()
+    result.ports = busses
+    return result
@@ -4,6 +4,8 @@
 
 import os
 
+from .bus.base import ValueBatch
+
 # Get BOM for excel csv
 
 
@@ -20,9 +22,14 @@ class Csv:
             self.file = open(filename, 'a')
 
     def __call__(self, values, variableprefix=''):
-        for v in values:
-            self.file.write('"{pf}{v.name}", {time}, {v.value:0.6g}, "{v.unit}"\n'
-                            .format(v=v, time=v.time.strftime('%Y-%m-%d %H:%M:%S'), pf=variableprefix))
+        if isinstance(values, ValueBatch):
+            rows = values.rows()
+        else:
+            rows = ((v.name, v.time, v.value, v.unit) for v in values)
+        for name, time, value, unit in rows:
+            self.file.write('"{pf}{name}", {time}, {value:0.6g}, "{unit}"\n'
+                            .format(name=name, time=time.strftime('%Y-%m-%d %H:%M:%S'), value=value,
+                                    unit=unit, pf=variableprefix))
         self.file.flush()
 
     def close(self):
@@ -1,5 +1,17 @@
 import asyncio
 import time
+import heapq
+import itertools
+import typing
+import weakref
+import collections
+
+from .bus import base
+from .bus.base import ValueBatch
+
+import logging
+logger = logging.getLogger(__name__)
+
 
 class TimeRaster:
     def __init__(self, seconds, offset=0):
@@ -10,6 +22,16 @@ class TimeRaster:
         now = time.time()
         return self.seconds - (now - self.offset) % self.seconds
 
+    def next(self, t: float) -> float:
+        """
+        The first time of the raster after t
+        :param t: Time as seconds since 1970-01-01 UTC
+        """
+        # The small epsilon keeps a time on the raster from being due again
+        n = (t - self.offset) // self.seconds + 1
+        due = self.offset + n * self.seconds
+        return due if due - t > 1e-6 else due + self.seconds
+
     def progress(self):
         return 1 - self.due_in() / self.seconds
 
@@ -29,7 +51,7 @@ every1hour = TimeRaster(60 * 60)
 class ReadTask(asyncio.Future):
     async def read(self):
         try:
-            res = await self.bus.read_all()
+            res = await self.reader(self.bus)
         except Exception as e:
             self.set_exception(e)
         else:
@@ -41,51 +63,421 @@ class ReadTask(asyncio.Future):
         else:
             return self.result()
 
-    def __init__(self, bus):
+    def __init__(self, bus, reader=None):
+        """
+        :param bus: The bus to read
+        :param reader: Coroutine function reading the bus, default is bus.read_all
+        """
         super().__init__()
         self.bus = bus
+        self.reader = reader or (lambda bus: bus.read_all())
         self.task = asyncio.ensure_future(self.read())
+        self.task.add_done_callback(self.finished)
+
+    def finished(self, task: asyncio.Task):
+        if task.cancelled() and not self.done():
+            super().cancel()
+
+    def cancel(self, msg=None):
+        """
+        Cancels the read of the bus. The task is done, when the read has finished its cleanup
+        """
+        return self.task.cancel(msg)
 
     def __repr__(self):
         return 'T({})'.format(self.bus)
 
 
+class ReadCoalescer:
+    """
+    Shares the reads of a bus between schedules.
+
+    A read of a bus started for the same tick of the scheduler is shared, whether it is still
+    running or finished: all callers get the same ValueBatch (or exception). Hence a bus in
+    several schedules is read once, when their ticks coincide, and each tick reads the bus anew.
+    The shared read is cancelled only, if all callers waiting for it are cancelled.
+    """
+    def __init__(self):
+        # bus -> (due time of the tick, read task, number of waiting callers, partial values)
+        self.reads: typing.Dict[typing.Any, typing.List] = {}
+        # Number of reads from the bus and of shared reads
+        self.count = 0
+        self.shared = 0
+
+    async def read(self, bus, tick: float = None) -> ValueBatch:
+        """
+        Reads all values of the bus or shares the read of the same tick
+        :param tick: The due time of the scheduler tick, None reads the bus without sharing
+        """
+        entry = self.reads.get(bus)
+        if entry and tick is not None and entry[0] == tick:
+            self.shared += 1
+        else:
+            # The read collects the values of finished sensors in partial
+            partial = ValueBatch()
+            token = base.partial.set(partial)
+            try:
+                entry = self.reads[bus] = [tick, asyncio.ensure_future(bus.read_all()), 0, partial]
+            finally:
+                base.partial.reset(token)
+            self.count += 1
+        entry[2] += 1
+        try:
+            return await asyncio.shield(entry[1])
+        except asyncio.CancelledError:
+            if entry[2] == 1:
+                # The last caller is gone, stop reading the bus and wait for its cleanup
+                entry[1].cancel()
+                await asyncio.wait([entry[1]])
+            raise
+        finally:
+            entry[2] -= 1
+
+    def partial(self, bus) -> ValueBatch:
+        """
+        The values of the sensors finished by the last read of the bus
+        """
+        entry = self.reads.get(bus)
+        return entry[3] if entry else ValueBatch()
+
+    def statistics(self) -> dict:
+        """
+        :return: The number of reads from the busses and of reads shared with other callers
+        """
+        return dict(reads=self.count, shared=self.shared)
+
+
+class Scheduler:
+    """
+    Dispatches the reads of all schedules of an event loop from one timer.
+
+    The due times of the schedules are kept in a heap on the monotonic clock of the loop,
+    anchored to the wall time. The schedules falling due in the same tick (within resolution)
+    start together. The lateness of each tick, the delay between the due time and the dispatch,
+    is recorded and passed to the ontick callback. Reads of the same bus started by several
+    schedules in the same tick are shared, see :py:class:`ReadCoalescer`. After a stall (eg. a
+    blocked loop or a suspend) each schedule starts once, the raster times missed meanwhile are
+    counted, not read.
+
+    Schedules use the default scheduler of their loop, unless another one is given.
+    """
+    __defaults: typing.MutableMapping[asyncio.AbstractEventLoop, 'Scheduler'] = weakref.WeakKeyDictionary()
+
+    def __init__(self, loop=None, resolution=0.01, ontick=None):
+        """
+        :param loop: The event loop, default is the current one
+        :param resolution: Schedules due within this time in seconds are dispatched in the same tick
+        :param ontick: Callback for each tick with the due wall time, the lateness in seconds and the started schedules
+        """
+        self.loop = loop or asyncio.get_event_loop()
+        self.resolution = resolution
+        self.ontick = ontick
+        self.reads = ReadCoalescer()
+        # Wall time - loop time
+        self.anchor = time.time() - self.loop.time()
+        # Heap of (loop time, number, schedule)
+        self.queue: typing.List[typing.Tuple[float, int, 'Schedule']] = []
+        self.counter = itertools.count()
+        self.timer: typing.Optional[asyncio.TimerHandle] = None
+        # Number, total and max lateness of the ticks
+        self.ticks = 0
+        self.total_lateness = 0.0
+        self.max_lateness = 0.0
+        # Number of raster times passed during stalls
+        self.missed = 0
+
+    @classmethod
+    def default(cls, loop=None) -> 'Scheduler':
+        """
+        The scheduler shared by all schedules of the loop
+        """
+        loop = loop or asyncio.get_event_loop()
+        if loop not in cls.__defaults:
+            cls.__defaults[loop] = cls(loop)
+        return cls.__defaults[loop]
+
+    def now(self) -> float:
+        """
+        The wall time as seconds since 1970-01-01 UTC from the monotonic clock
+        """
+        return self.loop.time() + self.anchor
+
+    def add(self, schedule: 'Schedule', after: float = None):
+        """
+        Queues the next reading of the schedule
+        :param after: Wall time after which the next raster time is searched, default now
+        """
+        due = schedule.raster.next(self.now() if after is None else after)
+        heapq.heappush(self.queue, (due - self.anchor, next(self.counter), schedule))
+        self.arm()
+
+    def remove(self, schedule: 'Schedule'):
+        self.queue = [entry for entry in self.queue if entry[2] is not schedule]
+        heapq.heapify(self.queue)
+        self.arm()
+
+    def due_in(self, schedule: 'Schedule') -> typing.Optional[float]:
+        """
+        Seconds until the next reading of the schedule, None if it is not queued
+        """
+        dues = [due for due, _, s in self.queue if s is schedule]
+        return min(dues) - self.loop.time() if dues else None
+
+    def arm(self):
+        """
+        Sets the timer to the first due time
+        """
+        if self.timer:
+            self.timer.cancel()
+            self.timer = None
+        if self.queue:
+            self.timer = self.loop.call_at(self.queue[0][0], self.tick)
+
+    def reanchor(self):
+        """
+        Follows a step of the wall clock (eg. by NTP) and requeues all schedules
+        """
+        step = time.time() - self.now()
+        if abs(step) > 1.0:
+            logger.warning(f'Wall clock stepped by {step:0.1f}s, requeue the schedules')
+            self.anchor += step
+            schedules = [s for _, _, s in self.queue]
+            self.queue.clear()
+            for schedule in schedules:
+                self.add(schedule)
+
+    def tick(self):
+        """
+        Starts the reading of all due schedules and queues their next reading
+        """
+        self.timer = None
+        self.reanchor()
+        now = self.loop.time()
+        if not self.queue or self.queue[0][0] > now + self.resolution:
+            # The wall clock stepped back, wait for the requeued schedules
+            return self.arm()
+        due = self.queue[0][0]
+        started = []
+        missed = 0
+        while self.queue and self.queue[0][0] <= now + self.resolution:
+            schedule_due, _, schedule = heapq.heappop(self.queue)
+            # The next raster time after now, the ones passed during a stall are skipped
+            missed += max(int((now - schedule_due) // schedule.raster.seconds), 0)
+            self.add(schedule, after=max(schedule_due, now) + self.anchor)
+            deadline = self.due_in(schedule) + self.loop.time()
+            schedule.task = self.loop.create_task(schedule.read(deadline, tick=due))
+            started.append(schedule)
+        lateness = now - due
+        self.ticks += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.missed += missed
+        if missed:
+            logger.warning(f'Tick {time.ctime(due + self.anchor)}: {lateness:0.1f}s late, {missed} raster times missed')
+        else:
+            logger.debug(f'Tick {time.ctime(due + self.anchor)}: {len(started)} schedules {lateness * 1000:0.1f}ms late')
+        if self.ontick:
+            self.ontick(due + self.anchor, lateness, started)
+        self.arm()
+
+    def statistics(self) -> dict:
+        """
+        :return: The number, mean and maximum lateness of the ticks in seconds and the missed raster times
+        """
+        return dict(count=self.ticks, mean=self.total_lateness / max(self.ticks, 1), max=self.max_lateness,
+                    missed=self.missed)
+
+
 class Schedule:
     """
     Schedules the read out of the logger busses it relates to timerasters
     """
 
-    def __init__(self, seconds, busses=None, offset=0, onread=None, *, loop=None):
+    def __init__(self, seconds, busses=None, offset=0, onread=None, *, loop=None, priority=None,
+                 history=None, max_gap=None, backfill_slots=1000, scheduler: Scheduler = None, grace=1.0):
+        """
+        :param seconds: Interval of the time raster
+        :param busses: The busses to read
+        :param offset: Offset of the time raster in seconds
+        :param onread: Callback for the read results, a list of (bus, ValueBatch or Exception)
+        :param priority: Priority for shared ports, lower first. Default is the interval, so fast schedules preempt slow ones
+        :param history: File to keep the time of the last logged value of each sensor value, enables the backfill
+                        of gaps for busses with a history (a backfill method, like addupi.Bus)
+        :param max_gap: Seconds between the last logged and a new value, that are treated as gap. Default 1.5 intervals
+        :param backfill_slots: The number of values per page of a backfill
+        :param scheduler: The timer of the schedule, default is the shared scheduler of the loop
+        :param grace: Seconds to wait for cancelled reads to clean up, eg. to release their serial port
+        """
+        self.priority = seconds if priority is None else priority
+        # The time of the last value logged without a gap before, by history key
+        self.history = base.Checkpoint(history) if history else None
+        # The time of the newest read value, by history key
+        self.latest = {}
+        self.max_gap = max_gap or 1.5 * seconds
+        self.backfill_slots = backfill_slots
+        # Running backfills by bus
+        self.backfills = {}
         if loop is None:
             self.loop = asyncio.get_event_loop()
         else:
             self.loop = loop
         self.busses = busses or []
         self.raster = TimeRaster(seconds, offset)
-        print('Schedule: 1st reading in {:0.1f}s'.format(self.raster.due_in()))
         self.onread = onread
-        self.task = self.loop.call_later(self.raster.due_in(), asyncio.ensure_future, self.read())
+        # The running read
+        self.task: typing.Optional[asyncio.Task] = None
+        self.grace = grace
+        # The read of each bus
+        self.running: typing.Dict[typing.Any, ReadTask] = {}
+        # Number of reads cancelled at the deadline and of reads skipped, as the last read did not end, by bus
+        self.timeouts = collections.Counter()
+        self.skipped = collections.Counter()
+        self.scheduler = scheduler or Scheduler.default(self.loop)
+        self.scheduler.add(self)
+        print('Schedule: 1st reading in {:0.1f}s'.format(self.scheduler.due_in(self)))
 
     def __str__(self):
         return ','.join(str(bus) for bus in self.busses) + ' (' + str(self.raster) + ')'
 
     def cancel(self):
-        self.task.cancel()
+        self.scheduler.remove(self)
+        if self.task:
+            self.task.cancel()
+        for task in self.running.values():
+            task.cancel()
+        for task in self.backfills.values():
+            task.cancel()
         print(time.ctime(), 'Cancelled:', self)
 
-    async def read(self):
-        # loop.call_later is not precise. make sure the time to run has really come
-        if self.raster.due_in() < self.raster.seconds * 0.5:
-            await asyncio.sleep(self.raster.due_in())
-        # Read the busses
-        pending = [ReadTask(bus) for bus in self.busses]
+    async def read(self, deadline: float = None, tick: float = None):
+        """
+        Reads the busses, started by the scheduler.
+
+        Reads still running at the deadline are cancelled, the values of their finished
+        sensors are passed to onread. A bus, that is still read by the last cycle after
+        the grace time, is skipped.
+        :param deadline: Loop time of the next reading, default from the raster
+        :param tick: Due time of the scheduler tick, the reads of a bus in the same tick are shared
+        """
+        # Read the busses, the read tasks inherit the priority
+        base.priority.set(self.priority)
+        if deadline is None:
+            deadline = self.loop.time() + self.raster.due_in()
+        pending = set()
+        for bus in await self.available():
+            task = self.running[bus] = ReadTask(bus, lambda bus: self.scheduler.reads.read(bus, tick))
+            pending.add(task)
         while pending:
-            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED, timeout=self.raster.due_in())
-            d: ReadTask
+            timeout = deadline - self.loop.time()
+            if timeout > 0:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED, timeout=timeout)
+            else:
+                # Cancel the late reads and give them the grace time to release their ports
+                for task in pending:
+                    task.cancel()
+                done, late = await asyncio.wait(pending, timeout=self.grace)
+                done |= late
+                pending = set()
+            results = [(d.bus, self.result(d)) for d in done]
             if self.onread:
-                self.onread([(d.bus, d.result_or_exception()) for d in done])
+                self.onread(results)
+            if self.history is not None:
+                self.track(results)
+
+    async def available(self) -> list:
+        """
+        The busses without a running read. Waits up to the grace time for the reads of the last cycle
+        """
+        previous = [task for task in self.running.values() if not task.done()]
+        if previous:
+            await asyncio.wait(previous, timeout=self.grace)
+        busses = []
+        for bus in self.busses:
+            if bus in self.running and not self.running[bus].done():
+                self.skipped[bus] += 1
+                print(time.ctime(), 'Skipped: {}, still read by the last cycle ({} times)'.format(bus, self.skipped[bus]))
+            else:
+                busses.append(bus)
+        return busses
+
+    def result(self, task: ReadTask):
+        """
+        The ValueBatch or Exception of a read, the values of the finished sensors of a late read
+        """
+        if not task.done() or task.cancelled():
+            self.timeouts[task.bus] += 1
+            values = self.scheduler.reads.partial(task.bus)
+            print(time.ctime(), 'Timeout: {} cancelled at the deadline with {} values'.format(task.bus, len(values)))
+            if values:
+                return values
+            return asyncio.TimeoutError('{} was not read until the deadline'.format(task.bus))
+        return task.result_or_exception()
+
+    @staticmethod
+    def keys(bus) -> dict:
+        """
+        The history keys of the valuefactories of a bus as 'sensor id/value id', value names repeat across sensors
+        """
+        return {vf: '{}/{}'.format(sensor.id, vf.id) for sensor in bus.sensors for vf in sensor.valuefactories}
+
+    def track(self, results):
+        """
+        Updates the history with the logged values and starts a backfill for busses with a gap
+        :param results: List of (bus, ValueBatch or Exception)
+        """
+        for bus, values in results:
+            if not isinstance(values, ValueBatch) or not hasattr(bus, 'backfill'):
+                continue
+            keys = self.keys(bus)
+            gap = {}
+            for factory, t in values.latest().items():
+                key = keys[factory]
+                self.latest[key] = max(t, self.latest.get(key, t))
+                last = self.history.get(key)
+                if bus in self.backfills:
+                    # The running backfill moves the history
+                    continue
+                elif last is not None and t - last > self.max_gap:
+                    gap[key] = (last, t)
+                else:
+                    self.history.advance({key: t})
+            if gap:
+                sensors = [s for s in bus.sensors if any(keys[vf] in gap for vf in s.valuefactories)]
+                since = min(last for last, t in gap.values()) + 1
+                until = max(t for last, t in gap.values())
+                self.backfills[bus] = asyncio.ensure_future(self.backfill(bus, sensors, since, until))
+        self.history.save()
+
+    async def backfill(self, bus, sensors, since: float, until: float):
+        """
+        Reads the missed values of the sensors from the history of the bus, in the background of the live reads
+        :param since: Time of the first missing value (epoch seconds)
+        :param until: Time of the first logged value after the gap (epoch seconds)
+        """
+        print(time.ctime(), 'Backfill: {} from {} to {}'.format(bus, base.fromtimestamp(since), base.fromtimestamp(until)))
+        # Live reads go first at shared ports
+        base.priority.set(float('inf'))
+        keys = self.keys(bus)
 
-        self.task = self.loop.call_later(self.raster.due_in(), asyncio.ensure_future, self.read())
+        def onread(values: ValueBatch):
+            if self.onread:
+                self.onread([(bus, values)])
+            self.history.advance({keys[factory]: t for factory, t in values.latest().items()})
+            self.history.save()
+
+        try:
+            await bus.backfill(base.fromtimestamp(since), onread, sensors=sensors, slots=self.backfill_slots,
+                               until=base.fromtimestamp(until), concurrency=1)
+        except Exception as e:
+            print(time.ctime(), 'Backfill failed: {}: {!r}'.format(bus, e))
+        else:
+            # The values after the gap are logged already
+            self.history.advance({keys[vf]: self.latest[keys[vf]]
+                                  for sensor in sensors for vf in sensor.valuefactories
+                                  if keys[vf] in self.latest})
+            self.history.save()
+        finally:
+            del self.backfills[bus]
 
 
 import datetime
@@ -102,7 +494,7 @@ async def read_at(t: datetime.datetime, *busses):
     await asyncio.sleep(sleeptime)
     tasks = [b.read_all() for b in busses]
     value_lists = await asyncio.gather(*tasks)
-    return sum(value_lists, start=[])
+    return ValueBatch.concat(*value_lists)
 
 
 